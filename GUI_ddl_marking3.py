@@ -1,13 +1,13 @@
-import csv
 import os
-import math
-from tkinter import Tk, Label, Button, Entry, Frame, filedialog, messagebox
+import threading
+from tkinter import Tk, Label, Button, Entry, Frame, Scale, Checkbutton, OptionMenu, IntVar, StringVar, filedialog, messagebox
 from PIL import Image, ImageTk
-from cv2 import (
-    findContours, RETR_EXTERNAL, CHAIN_APPROX_SIMPLE, cvtColor,
-    contourArea, drawContours, bitwise_not, COLOR_GRAY2BGR, COLOR_BGR2RGB
-)
-from numpy import array
+from marking_pipeline import ImageProcessor
+from marking_worker import BackgroundJob, Debouncer
+from marking_cache import StageCache, DiskCache, file_digest, DEFAULT_CACHE_DIR
+from marking_preview import make_proxy, render_live_preview
+from marking_loader import load_preview
+from marking_engine import crop_box, load_region
 
 
 class ImageProcessorGUI:
@@ -44,6 +44,11 @@ class ImageProcessorGUI:
         self.threshold_entry.grid(row=0, column=1)
         self.threshold_entry.insert(0, "30")
 
+        # 大津の方法でしきい値を自動で決めるチェックボックス
+        self.auto_threshold = IntVar(value=0)
+        self.auto_threshold_check = Checkbutton(self.middle_frame, text="自動", variable=self.auto_threshold)
+        self.auto_threshold_check.grid(row=0, column=3)
+
         # factor入力ボックス
         self.factor_label = Label(self.middle_frame, text="Factor:")
         self.factor_label.grid(row=1, column=0)
@@ -58,6 +63,11 @@ class ImageProcessorGUI:
         self.cutoff_entry.grid(row=2, column=1)
         self.cutoff_entry.insert(0, "100")
 
+        # ライブプレビュー用スライダー(ドラッグ中は縮小画像で再計算し、止まったら本処理を行う)
+        self.threshold_scale = self.create_slider(self.threshold_entry, 0, 255, row=0)
+        self.factor_scale = self.create_slider(self.factor_entry, 1, 50, row=1)
+        self.cutoff_scale = self.create_slider(self.cutoff_entry, 0, 5000, row=2)
+
         # 「再処理」ボタンと行数表示ラベルの追加
         self.reprocess_button = Button(self.middle_frame, text="再処理", command=self.reprocess_image)
         self.reprocess_button.grid(row=3, column=0, pady=5)
@@ -65,6 +75,33 @@ class ImageProcessorGUI:
         self.num_transitions_label = Label(self.middle_frame, text="行数：")
         self.num_transitions_label.grid(row=3, column=1, sticky="w")
 
+        # 処理状況の表示ラベル
+        self.status_label = Label(self.middle_frame, text="")
+        self.status_label.grid(row=3, column=2, sticky="w")
+
+        # マーキングヘッドの移動距離の表示ラベル
+        self.travel_label = Label(self.middle_frame, text="")
+        self.travel_label.grid(row=4, column=1, columnspan=2, sticky="w")
+
+        # 輪郭の出力順の選択(noneは検出順、nearestは最も近い輪郭から、2optはnearestをさらに改善)
+        self.contour_order = StringVar(value="none")
+        self.contour_order_label = Label(self.middle_frame, text="輪郭の順序:")
+        self.contour_order_label.grid(row=5, column=0)
+        self.contour_order_menu = OptionMenu(self.middle_frame, self.contour_order, "none", "nearest", "2opt",
+                                             command=self.on_option_changed)
+        self.contour_order_menu.grid(row=5, column=1, sticky="w")
+
+        # 輪郭の簡略化の許容誤差[出力座標の単位](0で簡略化しない)と、同じ向きに続く線分の結合
+        self.simplify_label = Label(self.middle_frame, text="簡略化:")
+        self.simplify_label.grid(row=6, column=0)
+        self.simplify_entry = Entry(self.middle_frame)
+        self.simplify_entry.grid(row=6, column=1)
+        self.simplify_entry.insert(0, "0")
+        self.merge_collinear = IntVar(value=1)
+        self.merge_collinear_check = Checkbutton(self.middle_frame, text="同じ向きの線分を結合",
+                                                 variable=self.merge_collinear, command=self.on_option_changed)
+        self.merge_collinear_check.grid(row=6, column=2, sticky="w")
+
         # 下段フレームの追加
         self.bottom_frame = Frame(root)
         self.bottom_frame.grid(row=2, column=0, columnspan=3, sticky="ew")
@@ -78,72 +115,180 @@ class ImageProcessorGUI:
         self.exit_button = Button(self.bottom_frame, text="EXIT", command=root.quit, width=20)
         self.exit_button.pack(side="left")
 
+        # 工程ごとのピークメモリも測るか(tracemallocを使うため、測定中は処理が遅くなる)
+        self.memory_profile = IntVar(value=0)
+        self.memory_profile_check = Checkbutton(self.bottom_frame, text="メモリ測定", variable=self.memory_profile)
+        self.memory_profile_check.pack(side="left", padx=(10, 0))
+
+        # 工程ごとの処理時間を表示するステータスバー
+        self.profile_label = Label(self.bottom_frame, text="", anchor="w")
+        self.profile_label.pack(side="left", padx=(10, 0))
+
 
         # 画像処理用変数
         self.image = None
         self.processed_image = None
+        self.image_lock = threading.Lock()
+
+        # 画像処理はワーカースレッドで実行し、画面を固めない
+        self.job = BackgroundJob(root)
+        self.live_job = BackgroundJob(root)
+        self.live_preview_debouncer = Debouncer(root, 30, self.start_live_preview)
+        self.settle_debouncer = Debouncer(root, 400, self.start_processing)
+
+        # 画像処理(パラメータの既定値はImageProcessorを参照)。工程ごとの処理結果をキャッシュし、
+        # 変更したパラメータ以降の工程だけを再計算する
+        self.processor = ImageProcessor()
+        self.processor.run_workers = os.cpu_count() or 1
+        self.processor.tile_workers = os.cpu_count() or 1
+        self.processor.stage_cache = StageCache()
+
+        # 最終的な座標とプレビュー画像はディスクにも保存し、再起動後や同じ画像の再読み込みでは処理を省く
+        self.processor.result_cache = DiskCache(DEFAULT_CACHE_DIR)
+
+        # 処理ごとの工程別の記録を追記するJSON Linesファイルのパス(Noneなら記録しない)
+        self.profile_log = None
 
     # 画像の読み込みを実行する関数
     def load_image(self):
         file_path = filedialog.askopenfilename()
         if file_path:
             self.image = Image.open(file_path)
-            self.preview_image(self.image, self.original_image_preview)
-            self.process_and_preview_image()
             self.file_path = file_path
-
-    # 画像処理を実行する関数
-    def process_and_preview_image(self):
-        self.cropped_image = self.crop_image(self.image)
-        self.edited_image = self.binarize_image(self.cropped_image)
-        self.marking_image = self.make_pixels_coarser(self.edited_image)
-        self.transitions = self.extract_transitions(self.marking_image)
-        self.pil_image_with_contours, self.filtered_contours = self.extract_contours()
-        self.coordinates_dict = self.flatten_contours()
-        self.num_transitions_label.configure(text=f"行数：v{len(self.transitions)}/r{len(self.coordinates_dict)}/t{len(self.transitions) + len(self.coordinates_dict)}")
-        self.preview_image(self.pil_image_with_contours, self.edited_image_preview)
-
-    # 画像を2:1にトリミングする関数
-    def crop_image(self, image):
-        new_width, new_height = image.size
-
-        new_long_side = max(new_width, new_height)
-        new_short_side = min(new_width, new_height)
-        if new_short_side * 2 > new_long_side:
-            new_new_height = new_long_side // 2 if new_height == new_short_side else new_height
-            new_new_width = new_long_side // 2 if new_width == new_short_side else new_width
-        else:
-            new_new_height = new_short_side if new_height == new_short_side else new_short_side * 2
-            new_new_width = new_short_side if new_width == new_short_side else new_short_side * 2
-        new_left = (new_width - new_new_width) / 2
-        new_top = (new_height - new_new_height) / 2
-        new_right = (new_width + new_new_width) / 2
-        new_bottom = (new_height + new_new_height) / 2
-        return image.crop((new_left, new_top, new_right, new_bottom))
-
-    # 画像を2値化処理する関数
-    def binarize_image(self, image):
-        threshold = int(self.threshold_entry.get() or 30)
-        grayscale_image = image.convert('L')
-        return grayscale_image.point(lambda x: 255 if x > threshold else 0, '1')
-
-    # 画像のピクセルを粗くする関数
-    def make_pixels_coarser(self, image):
+            self.processor.image_digest = None
+            self.start_processing(preview_original=True)
+
+    # 入力ボックスと連動するスライダーを作成する関数
+    def create_slider(self, entry, from_, to, row):
+        scale = Scale(self.middle_frame, from_=from_, to=to, orient="horizontal", showvalue=False, length=200,
+                      command=lambda value: self.on_slider(entry, value))
+        scale.set(int(entry.get()))
+        scale.grid(row=row, column=2, padx=(10, 0))
+        scale.bind("<ButtonRelease-1>", lambda event: self.settle_debouncer.flush())
+        return scale
+
+    # スライダー操作時に入力ボックスを更新し、プレビューを予約する関数
+    def on_slider(self, entry, value):
+        value = str(int(float(value)))
+        if entry.get() == value:
+            return
+        entry.delete(0, "end")
+        entry.insert(0, value)
+        if self.image is not None:
+            self.live_preview_debouncer.trigger()
+            self.settle_debouncer.trigger()
+
+    # 出力順などの選択を変えたときに再処理する関数
+    def on_option_changed(self, value=None):
+        if self.image is not None:
+            self.start_processing()
+
+    # 縮小画像でのプレビューをバックグラウンドで開始する関数
+    def start_live_preview(self):
+        self.load_parameter()
+        self.job.cancel()  # 古いパラメータでの本処理は止める
+        self.live_job.submit(lambda checkpoint: self.process_live_preview(), self.show_live_preview,
+                             on_error=self.show_error)
+
+    # 読み込んだ画像の切り出す範囲をデコードする関数(ワーカースレッドで実行)
+    # (本処理とライブプレビューのスレッドが遅延読み込みの画像を同時にデコードしないよう、ロックして1回だけ行う)
+    def decode_image(self):
+        with self.image_lock:
+            if getattr(self.image, 'tile', None):
+                load_region(self.image, crop_box(self.image.size))
+                self.image.load()
+
+    # 縮小画像でプレビュー画像を作成する関数(ワーカースレッドで実行)
+    def process_live_preview(self):
+        processor = self.processor
+        self.decode_image()
+        self.update_digest()
+        cropped_image = processor.cached('crop_image', (), lambda: processor.crop_image(self.image))
+        proxy = processor.cached('live_proxy', (), lambda: make_proxy(cropped_image))
+        return render_live_preview(proxy, cropped_image.size, processor.threshold, processor.factor,
+                                   processor.cutoff_area)
+
+    # 縮小画像でのプレビューを表示する関数
+    def show_live_preview(self, preview):
+        self.preview_image(preview, self.edited_image_preview)
+        self.status_label.configure(text="プレビュー(縮小画像)")
+
+    # 画像処理パラメータを更新
+    def load_parameter(self):
+        threshold = None if self.auto_threshold.get() else int(self.threshold_entry.get() or 30)
         factor = int(self.factor_entry.get() or 10)
-        original_width, original_height = image.size
-        resized_width = original_width // factor
-        resized_height = original_height // factor
-        coarser_image = image.resize((resized_width, resized_height), Image.NEAREST)
-        return coarser_image.resize((original_width, original_height), Image.NEAREST)
+        cutoff_area = int(self.cutoff_entry.get() or 100)
+        self.processor.set_parameters(threshold, factor, cutoff_area)
+        self.processor.profiler.memory = bool(self.memory_profile.get())
+        self.processor.contour_order = self.contour_order.get()
+        self.processor.simplify_tolerance = max(float(self.simplify_entry.get() or 0), 0.0)
+        self.processor.merge_collinear = bool(self.merge_collinear.get())
+
+    # キャッシュのキーにする画像のダイジェストを求める関数(読み込み後の最初の処理で1回だけ計算する)
+    def update_digest(self):
+        if self.processor.image_digest is None:
+            self.processor.image_digest = file_digest(self.file_path)
+
+    # 画像処理をバックグラウンドで開始する関数(処理中のジョブは中止する)
+    def start_processing(self, preview_original=False):
+        self.load_parameter()
+        self.settle_debouncer.cancel()
+        self.live_job.cancel()
+        self.status_label.configure(text="処理中…")
+        self.job.submit(
+            lambda checkpoint: self.process_and_preview_image(checkpoint, preview_original),
+            self.show_processed_image, self.show_progress, self.show_error
+        )
+
+    # 画像処理を実行する関数(ワーカースレッドで実行)
+    def process_and_preview_image(self, checkpoint=None, preview_original=False):
+        processor = self.processor
+        self.decode_image()
+        self.update_digest()
+        processor.process_image(self.image, checkpoint)
+
+        previews = {}
+        if preview_original:
+            previews['original'] = processor.cached('preview_original', (), lambda: load_preview(self.file_path))
+        previews['edited'] = processor.profiler.measure('preview_edited', processor.preview)
+        return previews
+
+    # 工程ごとの処理時間をステータスバーに表示し、必要ならファイルに記録する関数
+    def show_profile(self, event):
+        processor = self.processor
+        self.profile_label.configure(text=processor.profiler.summary())
+        if self.profile_log:
+            processor.profiler.write_jsonl(self.profile_log, event=event, image=self.file_path,
+                                           threshold=processor.threshold, factor=processor.factor,
+                                           cutoff_area=processor.cutoff_area)
+
+    # 画像処理の結果を画面に反映する関数
+    def show_processed_image(self, previews):
+        processor = self.processor
+        if 'original' in previews:
+            self.preview_image(previews['original'], self.original_image_preview)
+        num_transitions, num_contours = processor.segment_counts
+        self.num_transitions_label.configure(text=f"行数：v{num_transitions}/r{num_contours}/t{num_transitions + num_contours}→{len(processor.scheduled_segments)}")
+        self.travel_label.configure(text=f"移動距離：{processor.travel[0]:.1f}→{processor.travel[1]:.1f}")
+        self.show_profile('process')
+        self.preview_image(previews['edited'], self.edited_image_preview)
+        if processor.threshold is None:
+            self.status_label.configure(text=f"自動しきい値：{processor.applied_threshold}")
+        else:
+            self.status_label.configure(text="")
+
+    # 画像処理の進捗を表示する関数
+    def show_progress(self, step, total, message):
+        self.status_label.configure(text=f"処理中… {message} ({step}/{total})")
+
+    # 画像処理のエラーを表示する関数
+    def show_error(self, error):
+        self.status_label.configure(text="")
+        messagebox.showerror("エラー", f"画像処理に失敗しました。\n{error}")
 
     # 画像のプレビューを表示する関数
     def preview_image(self, image, label):
-        img_copy = image.copy()
-        base_width = 320
-        w_percent = (base_width / float(img_copy.size[0]))
-        h_size = int((float(img_copy.size[1]) * float(w_percent)))
-        img_resized = img_copy.resize((base_width, h_size), Image.LANCZOS)
-        img = ImageTk.PhotoImage(img_resized)
+        img = ImageTk.PhotoImage(image)
         label.configure(image=img)
         label.image = img
 
@@ -152,137 +297,27 @@ class ImageProcessorGUI:
         if self.image is None:
             messagebox.showwarning("警告", "画像が読み込まれていません。")
             return
-        self.process_and_preview_image()
-
-    # 塗りつぶしの座標を抽出する関数
-    def extract_transitions(self, image):
-        transitions = {}
-        width, height = image.size
-        
-        pixels = image.load()
-        index = 0
-        for y in range(height):
-            start = None
-            for x in range(width):
-                current_pixel = pixels[x, y]
-                if start is None and current_pixel == 0:
-                    start = (x, y)
-                elif start is not None and current_pixel == 255:
-                    end = (x, y)
-                    transitions[index] = (start[0], start[1], end[0], end[1])
-                    index += 1
-                    start = None
-        self.num_transitions_label.configure(text=f"行数：{len(transitions)}")
-        return transitions
-
-    # 輪郭を抽出する関数
-    def extract_contours(self):
-        edited_image_cv = array(self.edited_image.convert('L'))
-        bw_image_cv = bitwise_not(edited_image_cv)
-        contours, _ = findContours(bw_image_cv, RETR_EXTERNAL, CHAIN_APPROX_SIMPLE)
-
-        cutoff_area = int(self.cutoff_entry.get() or 100)
-        filtered_contours = [cnt for cnt in contours if cutoff_area <= contourArea(cnt)]
-
-        marking_image_cv = array(self.marking_image.convert('L'))
-        grayscale_bgr_image = cvtColor(marking_image_cv, COLOR_GRAY2BGR)
-        drawContours(grayscale_bgr_image, filtered_contours, -1, (0, 0, 255), 2)
-        pil_image_with_contours = Image.fromarray(cvtColor(grayscale_bgr_image, COLOR_BGR2RGB))
-
-        return pil_image_with_contours, filtered_contours
-
-    # 輪郭抽出した座標を変換する関数
-    def flatten_contours(self):
-        # 輪郭の座標をひとつの配列に集約する
-        coordinates_dict = {}
-        key_num = 1
-        for contour in self.filtered_contours:
-
-            flattened_list = []
-            for point in contour:
-                x, y = point[0]
-                flattened_list.append((x, y))
-
-            # 輪郭の座標を辞書変数に再構築する
-            for i in range(len(flattened_list) - 1):
-                x1, y1 = flattened_list[i]
-                x2, y2 = flattened_list[i + 1]
-                coordinates_dict[key_num + i] = [x1, y1, x2, y2]
-
-            key_num += i + 1
-
-        return coordinates_dict
+        self.start_processing()
 
     # csvファイルを作成実行する関数
     def csv_run(self):
         if self.image is None:
             messagebox.showwarning("警告", "画像が読み込まれていません。")
+        elif self.job.busy:
+            messagebox.showwarning("警告", "画像処理中です。完了後に再度実行してください。")
+        elif not self.processor.is_current():
+            messagebox.showwarning("警告", "現在のパラメータでの処理が完了していません。再処理してから実行してください。")
         else:
-            merged_dict = self.merge_dictionaries()
-            rotated_dict = self.rotate_90(merged_dict)
-            scaled_and_offset_dict = self.scale_and_offset(rotated_dict)
-            self.save_dict_to_csv(scaled_and_offset_dict)
-
-    # 塗と輪郭の座標を結合する関数
-    def merge_dictionaries(self):
-        last_key = max(self.transitions.keys()) if self.transitions else 0
-        updated_coordinates_dict = {key + last_key: value for key, value in self.coordinates_dict.items()}
-        merged_dict = {**self.transitions, **updated_coordinates_dict}
-
-        return merged_dict
-
-    # 座標を90度回転する関数
-    def rotate_90(self, merged_dict):
-        rotated_dict = {}
-        for index, (x1, y1, x2, y2) in merged_dict.items():
-            # 各点に対して90度回転を実行
-            new_x1, new_y1 = -y1, x1
-            new_x2, new_y2 = -y2, x2
-            rotated_dict[index] = (new_x1, new_y1, new_x2, new_y2)
-        return rotated_dict
-
-    # 座標を縮小とオフセットする関数
-    def scale_and_offset(self, rotated_dict):
-        # self.edited_imageのサイズを取得
-        width, height = self.edited_image.size
-        
-        # 長い辺と短い辺の判定
-        long_side = max(width, height)
-        short_side = min(width, height)
-        
-        # 縮尺の計算
-        scale_long = 40 / long_side
-        scale_short = 20 / short_side
-        
-        scaled_and_offset_dict = {}
-        for index, (x1, y1, x2, y2) in rotated_dict.items():
-            # 縮尺適用
-            new_x1 = round(x1 * scale_short, 2)
-            new_y1 = round(y1 * scale_long, 2)
-            new_x2 = round(x2 * scale_short, 2)
-            new_y2 = round(y2 * scale_long, 2)
-            
-            # オフセット適用
-            new_x1 = round(new_x1 + 10, 2)
-            new_y1 = round(new_y1 - 20, 2)
-            new_x2 = round(new_x2 + 10, 2)
-            new_y2 = round(new_y2 - 20, 2)
-            
-            scaled_and_offset_dict[index] = (new_x1, new_y1, new_x2, new_y2)
-            
-        return scaled_and_offset_dict
-
-    # csvファイルを保存する関数
-    def save_dict_to_csv(self, edited_dict):
+            self.processor.profiler.reset()
+            self.save_segments()
+            self.show_profile('export')
+
+    # 座標ファイルを画像と同じディレクトリにzahyou.<形式>として保存する関数
+    def save_segments(self):
         image_directory = os.path.dirname(self.file_path)
-        csv_file_path = os.path.join(image_directory, 'zahyou.csv')
-
-        with open(csv_file_path, mode='w', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow(['Index', 'X1', 'Y1', 'X2', 'Y2'])
-            
-            for index, (x1, y1, x2, y2) in edited_dict.items():
-                writer.writerow([index, x1, y1, x2, y2])
+        output_paths = {output_format: os.path.join(image_directory, f'zahyou.{output_format}')
+                        for output_format in self.processor.output_formats}
+        self.processor.export(output_paths)
 
         messagebox.showinfo("完了", "csvファイル出力完了")
 
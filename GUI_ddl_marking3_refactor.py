@@ -1,23 +1,33 @@
-import csv
 import os
-import math
-from tkinter import Tk, Label, Button, Entry, Frame, filedialog, messagebox
+import threading
+from tkinter import Tk, Label, Button, Entry, Frame, Scale, Checkbutton, IntVar, filedialog, messagebox
 from PIL import Image, ImageTk
-from cv2 import (
-    findContours, RETR_EXTERNAL, CHAIN_APPROX_SIMPLE, cvtColor,
-    contourArea, drawContours, bitwise_not, COLOR_GRAY2BGR, COLOR_BGR2RGB
-)
-from numpy import array
+from marking_pipeline import ImageProcessor
+from marking_cache import DiskCache, file_digest, DEFAULT_CACHE_DIR
+from marking_worker import BackgroundJob, Debouncer
+from marking_preview import make_proxy, render_live_preview
+from marking_loader import load_preview
+from marking_engine import crop_box, load_region
 
 class GUIComponents:
     def __init__(self, root):
         self.root = root
         self.image_processor = ImageProcessor()  # GUI内で画像処理クラスのインスタンスを生成
+        self.image_processor.flip = True  # 左右反転し、粗い画像の画素単位の座標で出力する
+        self.image_processor.coarse_coordinates = True
+        # 最終的な座標とプレビュー画像をディスクに保存し、同じ画像・パラメータでは処理を省く
+        self.image_processor.result_cache = DiskCache(DEFAULT_CACHE_DIR)
+        self.job = BackgroundJob(root)  # 画像処理はワーカースレッドで実行し、画面を固めない
+        self.live_job = BackgroundJob(root)
+        self.live_preview_debouncer = Debouncer(root, 30, self.start_live_preview)
+        self.settle_debouncer = Debouncer(root, 400, self.start_processing)
         self.setup_ui()
 
         # ロードする画像情報の保存変数
         self.file_path = None
         self.image = None
+        self.live_proxy = None  # ライブプレビュー用の縮小画像と元のサイズ
+        self.image_lock = threading.Lock()
 
     def setup_ui(self):
         self.initialize_gui()
@@ -59,6 +69,11 @@ class GUIComponents:
         self.threshold_entry.grid(row=0, column=1)
         self.threshold_entry.insert(0, str(self.image_processor.threshold))
 
+        # 大津の方法でしきい値を自動で決めるチェックボックス
+        self.auto_threshold = IntVar(value=0)
+        self.auto_threshold_check = Checkbutton(self.middle_frame, text="自動", variable=self.auto_threshold)
+        self.auto_threshold_check.grid(row=0, column=3)
+
         # factor入力ボックス
         self.factor_label = Label(self.middle_frame, text="Factor:")
         self.factor_label.grid(row=1, column=0)
@@ -73,6 +88,11 @@ class GUIComponents:
         self.cutoff_entry.grid(row=2, column=1)
         self.cutoff_entry.insert(0, str(self.image_processor.cutoff_area))
 
+        # ライブプレビュー用スライダー(ドラッグ中は縮小画像で再計算し、止まったら本処理を行う)
+        self.threshold_scale = self.create_slider(self.threshold_entry, 0, 255, row=0)
+        self.factor_scale = self.create_slider(self.factor_entry, 1, 50, row=1)
+        self.cutoff_scale = self.create_slider(self.cutoff_entry, 0, 5000, row=2)
+
         # 「再処理」ボタンと行数表示ラベルの追加
         self.reprocess_button = Button(self.middle_frame, text="再処理", command=self.reprocess_image)
         self.reprocess_button.grid(row=3, column=0, pady=5)
@@ -80,6 +100,10 @@ class GUIComponents:
         self.num_transitions_label = Label(self.middle_frame, text="行数：")
         self.num_transitions_label.grid(row=3, column=1, sticky="w")
 
+        # 処理状況の表示ラベル
+        self.status_label = Label(self.middle_frame, text="")
+        self.status_label.grid(row=3, column=2, sticky="w")
+
     def setup_bottom_frame(self):
         # 下段フレームの追加
         self.bottom_frame = Frame(self.root)
@@ -94,35 +118,143 @@ class GUIComponents:
         self.exit_button = Button(self.bottom_frame, text="EXIT", command=root.quit, width=20)
         self.exit_button.pack(side="left")
 
+        # 工程ごとのピークメモリも測るか(tracemallocを使うため、測定中は処理が遅くなる)
+        self.memory_profile = IntVar(value=0)
+        self.memory_profile_check = Checkbutton(self.bottom_frame, text="メモリ測定", variable=self.memory_profile)
+        self.memory_profile_check.pack(side="left", padx=(10, 0))
+
+        # 工程ごとの処理時間を表示するステータスバー
+        self.profile_label = Label(self.bottom_frame, text="", anchor="w")
+        self.profile_label.pack(side="left", padx=(10, 0))
+        self.profile_log = None  # 処理ごとの記録を追記するJSON Linesファイルのパス(Noneなら記録しない)
+
     # 画像の読み込みを実行する関数
     def load_image(self):
         self.file_path = filedialog.askopenfilename()
         if self.file_path:
-            # オリジナル画像のプレビュー
             self.image = Image.open(self.file_path)
-            self.preview_image(self.image, self.original_image_preview)
+            self.image_processor.image_digest = None
+            self.live_proxy = None
+            self.start_processing(preview_original=True)
+
+    # 入力ボックスと連動するスライダーを作成する関数
+    def create_slider(self, entry, from_, to, row):
+        scale = Scale(self.middle_frame, from_=from_, to=to, orient="horizontal", showvalue=False, length=200,
+                      command=lambda value: self.on_slider(entry, value))
+        scale.set(int(entry.get()))
+        scale.grid(row=row, column=2, padx=(10, 0))
+        scale.bind("<ButtonRelease-1>", lambda event: self.settle_debouncer.flush())
+        return scale
+
+    # スライダー操作時に入力ボックスを更新し、プレビューを予約する関数
+    def on_slider(self, entry, value):
+        value = str(int(float(value)))
+        if entry.get() == value:
+            return
+        entry.delete(0, "end")
+        entry.insert(0, value)
+        if self.image is not None:
+            self.live_preview_debouncer.trigger()
+            self.settle_debouncer.trigger()
+
+    # 縮小画像でのプレビューをバックグラウンドで開始する関数
+    def start_live_preview(self):
+        self.load_parameter()
+        self.job.cancel()  # 古いパラメータでの本処理は止める
+        self.live_job.submit(lambda checkpoint: self.process_live_preview(self.image), self.show_live_preview,
+                             on_error=self.show_error)
+
+    # 読み込んだ画像の切り出す範囲をデコードする関数(ワーカースレッドで実行)
+    # (本処理とライブプレビューのスレッドが遅延読み込みの画像を同時にデコードしないよう、ロックして1回だけ行う)
+    def decode_image(self, image):
+        with self.image_lock:
+            if getattr(image, 'tile', None):
+                load_region(image, crop_box(image.size))
+                image.load()
+
+    # 縮小画像でプレビュー画像を作成する関数(ワーカースレッドで実行)
+    def process_live_preview(self, image):
+        processor = self.image_processor
+        self.decode_image(image)
+        if self.live_proxy is None:
+            flipped_image = processor.flip_image_horizontally(processor.crop_image(image))
+            self.live_proxy = (make_proxy(flipped_image), flipped_image.size)
+        proxy, full_size = self.live_proxy
+        return render_live_preview(proxy, full_size, processor.threshold, processor.factor)
+
+    # 縮小画像でのプレビューを表示する関数
+    def show_live_preview(self, preview):
+        self.preview_image(preview, self.edited_image_preview)
+        self.status_label.configure(text="プレビュー(縮小画像)")
+
+    # 画像処理をバックグラウンドで開始する関数(処理中のジョブは中止する)
+    def start_processing(self, preview_original=False):
+        self.load_parameter()
+        self.settle_debouncer.cancel()
+        self.live_job.cancel()
+        self.status_label.configure(text="処理中…")
+        self.job.submit(
+            lambda checkpoint: self.process_and_preview_image(self.image, checkpoint, preview_original),
+            self.show_processed_image, self.show_progress, self.show_error
+        )
+
+    # 画像処理とプレビュー画像の作成を実行する関数(ワーカースレッドで実行)
+    def process_and_preview_image(self, image, checkpoint=None, preview_original=False):
+        previews = {}
+        if preview_original:
+            previews['original'] = load_preview(self.file_path)
+        if self.image_processor.image_digest is None:
+            self.image_processor.image_digest = file_digest(self.file_path)
+        self.decode_image(image)
+        segments = self.image_processor.process_image(image, checkpoint)
+        previews['edited'] = self.image_processor.preview()
+        return previews, segments
+
+    # 画像処理の結果を画面に反映する関数
+    def show_processed_image(self, result):
+        previews, segments = result
+        # オリジナル画像のプレビュー
+        if 'original' in previews:
+            self.preview_image(previews['original'], self.original_image_preview)
 
-            # 編集画像のプレビュー
-            self.load_parameter()
-            edited_image, transitions = self.image_processor.process_image(self.image)
-            self.preview_image(edited_image, self.edited_image_preview)
-            self.num_transitions_label.configure(text=f"行数：{len(transitions)}")
+        # 編集画像のプレビュー
+        self.preview_image(previews['edited'], self.edited_image_preview)
+        self.num_transitions_label.configure(text=f"行数：{len(segments)}")
+        self.show_profile()
+        if self.image_processor.threshold is None:
+            self.status_label.configure(text=f"自動しきい値：{self.image_processor.applied_threshold}")
+        else:
+            self.status_label.configure(text="")
+
+    # 工程ごとの処理時間をステータスバーに表示し、必要ならファイルに記録する関数
+    def show_profile(self, event='process'):
+        profiler = self.image_processor.profiler
+        self.profile_label.configure(text=profiler.summary())
+        if self.profile_log:
+            profiler.write_jsonl(self.profile_log, event=event, image=self.file_path,
+                                 threshold=self.image_processor.threshold, factor=self.image_processor.factor,
+                                 cutoff_area=self.image_processor.cutoff_area)
+
+    # 画像処理の進捗を表示する関数
+    def show_progress(self, step, total, message):
+        self.status_label.configure(text=f"処理中… {message} ({step}/{total})")
+
+    # 画像処理のエラーを表示する関数
+    def show_error(self, error):
+        self.status_label.configure(text="")
+        messagebox.showerror("エラー", f"画像処理に失敗しました。\n{error}")
 
     # 画像処理パラメータを更新
     def load_parameter(self):
-        threshold = int(self.threshold_entry.get() or 30)
+        threshold = None if self.auto_threshold.get() else int(self.threshold_entry.get() or 30)
         factor = int(self.factor_entry.get() or 10)
         cutoff_area = int(self.cutoff_entry.get() or 100)
         self.image_processor.set_parameters(threshold, factor, cutoff_area)
+        self.image_processor.profiler.memory = bool(self.memory_profile.get())
 
     # 画像のプレビューを表示する関数
     def preview_image(self, image, label):
-        img_copy = image.copy()
-        base_width = 320
-        w_percent = (base_width / float(img_copy.size[0]))
-        h_size = int((float(img_copy.size[1]) * float(w_percent)))
-        img_resized = img_copy.resize((base_width, h_size), Image.LANCZOS)
-        img = ImageTk.PhotoImage(img_resized)
+        img = ImageTk.PhotoImage(image)
         label.configure(image=img)
         label.image = img
 
@@ -131,113 +263,24 @@ class GUIComponents:
         if self.image is None:
             messagebox.showwarning("警告", "画像が読み込まれていません。")
             return
-
-        # 編集画像のプレビュー
-        self.load_parameter()
-        edited_image, transitions = self.image_processor.process_image(self.image)
-        self.preview_image(edited_image, self.edited_image_preview)
-        self.num_transitions_label.configure(text=f"行数：{len(transitions)}")
+        self.start_processing()
 
     # csvファイルを作成実行する関数
     def trigger_csv_creation(self):
-        pass
-
-class ImageProcessor:
-    def __init__(self):
-        # デフォルトパラメータの初期化
-        self.threshold = 30
-        self.factor = 10
-        self.cutoff_area = 100
-
-    # パラメータの更新
-    def set_parameters(self, threshold, factor, cutoff_area):
-        self.threshold = threshold
-        self.factor = factor
-        self.cutoff_area = cutoff_area
-
-    # 画像処理を実行する関数
-    def process_image(self, image):
-        cropped_image = self.crop_image(image)
-        flipped_image = self.flip_image_horizontally(cropped_image)
-        binarized_image = self.binarize_image(flipped_image)
-        pixeled_image = self.make_pixels_coarser(binarized_image)
-
-        transitions = self.extract_transitions(pixeled_image)
-
-        return pixeled_image, transitions
-
-    # 画像を2:1にトリミングする関数
-    def crop_image(self, image):
-        new_width, new_height = image.size
-
-        new_long_side = max(new_width, new_height)
-        new_short_side = min(new_width, new_height)
-        if new_short_side * 2 > new_long_side:
-            new_new_height = new_long_side // 2 if new_height == new_short_side else new_height
-            new_new_width = new_long_side // 2 if new_width == new_short_side else new_width
+        if self.image is None:
+            messagebox.showwarning("警告", "画像が読み込まれていません。")
+        elif self.job.busy:
+            messagebox.showwarning("警告", "画像処理中です。完了後に再度実行してください。")
+        elif not self.image_processor.is_current():
+            messagebox.showwarning("警告", "現在のパラメータでの処理が完了していません。再処理してから実行してください。")
         else:
-            new_new_height = new_short_side if new_height == new_short_side else new_short_side * 2
-            new_new_width = new_short_side if new_width == new_short_side else new_short_side * 2
-        new_left = (new_width - new_new_width) / 2
-        new_top = (new_height - new_new_height) / 2
-        new_right = (new_width + new_new_width) / 2
-        new_bottom = (new_height + new_new_height) / 2
-        return image.crop((new_left, new_top, new_right, new_bottom))
-
-    # 画像を左右反転させる関数
-    def flip_image_horizontally(self, image):
-        return image.transpose(Image.FLIP_LEFT_RIGHT)
-
-    # 画像を2値化処理する関数
-    def binarize_image(self, image):
-        grayscale_image = image.convert('L')
-        return grayscale_image.point(lambda x: 255 if x > self.threshold else 0, '1')
-
-    # 画像のピクセルを粗くする関数
-    def make_pixels_coarser(self, image):
-        original_width, original_height = image.size
-        resized_width = original_width // self.factor
-        resized_height = original_height // self.factor
-        coarser_image = image.resize((resized_width, resized_height), Image.NEAREST)
-        return coarser_image
-
-    # 塗りつぶしの座標を抽出する関数
-    def extract_transitions(self, image):
-        transitions = {}
-        width, height = image.size
-        
-        pixels = image.load()
-        index = 0
-        for y in range(height):
-            start = None
-            for x in range(width):
-                current_pixel = pixels[x, y]
-                if start is None and current_pixel == 0:
-                    start = (x, y)
-                elif start is not None and current_pixel == 255:
-                    end = (x, y)
-                    transitions[index] = (start[0], start[1], end[0], end[1])
-                    index += 1
-                    start = None
-        return transitions
-
-    def extract_contours(self):
-        pass
-
-    def flatten_contours(self):
-        pass
-
-    def merge_dictionaries(self):
-        pass
-
-    def rotate_90(self):
-        pass
-
-    def scale_and_offset(self):
-        pass
-
-    def save_dict_to_csv(self):
-        pass
+            processor = self.image_processor
+            processor.profiler.reset()
+            image_directory = os.path.dirname(self.file_path)
+            processor.export({output_format: os.path.join(image_directory, f'zahyou.{output_format}')
+                              for output_format in processor.output_formats})
+            self.show_profile('export')
+            messagebox.showinfo("完了", "csvファイル出力完了")
 
 if __name__ == "__main__":
     root = Tk()
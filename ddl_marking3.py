@@ -1,7 +1,10 @@
 from tkinter import Tk, Label, Button, Entry, Frame, filedialog, messagebox
 from PIL import Image, ImageTk
 import os
-import csv
+from marking_engine import write_segments_csv
+from marking_pipeline import ImageProcessor
+from marking_worker import BackgroundJob
+from marking_loader import load_preview
 
 class ImageProcessorGUI:
     def __init__(self, root):
@@ -51,6 +54,10 @@ class ImageProcessorGUI:
         self.num_transitions_label = Label(self.middle_frame, text="行数：")
         self.num_transitions_label.grid(row=2, column=1, sticky="w")
 
+        # 処理状況の表示ラベル
+        self.status_label = Label(self.middle_frame, text="")
+        self.status_label.grid(row=2, column=2, sticky="w")
+
         # 下段フレームの追加
         self.bottom_frame = Frame(root)
         self.bottom_frame.grid(row=2, column=0, columnspan=3, sticky="ew")
@@ -68,53 +75,59 @@ class ImageProcessorGUI:
         self.image = None
         self.processed_image = None
 
+        # 塗りだけを画素単位の座標のまま出力する
+        self.processor = ImageProcessor()
+        self.processor.include_contours = False
+
+        # 画像処理はワーカースレッドで実行し、画面を固めない
+        self.job = BackgroundJob(root)
+
     def load_image(self):
         file_path = filedialog.askopenfilename()
         if file_path:
             self.image = Image.open(file_path)
-            self.preview_image(self.image, self.original_image_preview)
-            self.edited_image = self.binarize_image((self.crop_image(self.image)))
-            self.marking_image = self.make_pixels_coarser(self.edited_image)
-            self.preview_image(self.marking_image, self.edited_image_preview)
             self.file_path = file_path
+            self.start_processing(preview_original=True)
 
-    def crop_image(self, image):
-        new_width, new_height = image.size
-
-        new_long_side = max(new_width, new_height)
-        new_short_side = min(new_width, new_height)
-        if new_short_side * 2 > new_long_side:
-            new_new_height = new_long_side // 2 if new_height == new_short_side else new_height
-            new_new_width = new_long_side // 2 if new_width == new_short_side else new_width
-        else:
-            new_new_height = new_short_side if new_height == new_short_side else new_short_side * 2
-            new_new_width = new_short_side if new_width == new_short_side else new_short_side * 2
-        new_left = (new_width - new_new_width) / 2
-        new_top = (new_height - new_new_height) / 2
-        new_right = (new_width + new_new_width) / 2
-        new_bottom = (new_height + new_new_height) / 2
-        return image.crop((new_left, new_top, new_right, new_bottom))
-
-    def binarize_image(self, image):
+    def load_parameter(self):
         threshold = int(self.threshold_entry.get() or 30)
-        grayscale_image = image.convert('L')
-        return grayscale_image.point(lambda x: 255 if x > threshold else 0, '1')
-
-    def make_pixels_coarser(self, image):
         factor = int(self.factor_entry.get() or 10)
-        original_width, original_height = image.size
-        resized_width = original_width // factor
-        resized_height = original_height // factor
-        coarser_image = image.resize((resized_width, resized_height), Image.NEAREST)
-        return coarser_image.resize((original_width, original_height), Image.NEAREST)
+        self.processor.set_parameters(threshold, factor, 0)
+
+    # 画像処理をバックグラウンドで開始する(処理中のジョブは中止する)
+    def start_processing(self, preview_original=False):
+        self.load_parameter()
+        self.status_label.configure(text="処理中…")
+        self.job.submit(
+            lambda checkpoint: self.process_and_preview_image(checkpoint, preview_original),
+            self.show_processed_image, self.show_progress, self.show_error
+        )
+
+    # ワーカースレッドで実行する画像処理
+    def process_and_preview_image(self, checkpoint=None, preview_original=False):
+        previews = {}
+        if preview_original:
+            previews['original'] = load_preview(self.file_path, 250)
+        self.transitions = self.processor.process_image(self.image, checkpoint)
+        previews['edited'] = self.processor.render_preview(250)
+        return previews
+
+    def show_processed_image(self, previews):
+        if 'original' in previews:
+            self.preview_image(previews['original'], self.original_image_preview)
+        self.preview_image(previews['edited'], self.edited_image_preview)
+        self.num_transitions_label.configure(text=f"行数：{len(self.transitions)}")  # 行数を更新
+        self.status_label.configure(text="")
+
+    def show_progress(self, step, total, message):
+        self.status_label.configure(text=f"処理中… {message} ({step}/{total})")
+
+    def show_error(self, error):
+        self.status_label.configure(text="")
+        messagebox.showerror("エラー", f"画像処理に失敗しました。\n{error}")
 
     def preview_image(self, image, label):
-        img_copy = image.copy()
-        base_width = 250  # 画像の幅を適切に設定
-        w_percent = (base_width / float(img_copy.size[0]))
-        h_size = int((float(img_copy.size[1]) * float(w_percent)))
-        img_resized = img_copy.resize((base_width, h_size), Image.LANCZOS)
-        img = ImageTk.PhotoImage(img_resized)
+        img = ImageTk.PhotoImage(image)
         label.configure(image=img)
         label.image = img
 
@@ -122,48 +135,20 @@ class ImageProcessorGUI:
         if self.image is None:
             messagebox.showwarning("警告", "画像が読み込まれていません。")
             return
-        self.edited_image = self.binarize_image((self.crop_image(self.image)))
-        self.marking_image = self.make_pixels_coarser(self.edited_image)
-        self.transitions = self.extract_transitions(self.marking_image)
-        self.num_transitions_label.configure(text=f"行数：{len(self.transitions)}")
-        self.preview_image(self.marking_image, self.edited_image_preview)
-
-    def extract_transitions(self, image):
-        transitions = {}
-        width, height = image.size
-        
-        pixels = image.load()
-        index = 0
-        for y in range(height):
-            start = None
-            for x in range(width):
-                current_pixel = pixels[x, y]
-                if start is None and current_pixel == 0:
-                    start = (x, y)
-                elif start is not None and current_pixel == 255:
-                    end = (x, y)
-                    transitions[index] = (start[0], start[1], end[0], end[1])
-                    index += 1
-                    start = None
-        self.num_transitions_label.configure(text=f"行数：{len(transitions)}")  # 行数を更新
-        return transitions
+        self.start_processing()
 
     def csv_run(self):
         if self.image is None:  # edited_imageがNoneの場合、警告を表示
             messagebox.showwarning("警告", "画像が読み込まれていません。")
+        elif self.job.busy:
+            messagebox.showwarning("警告", "画像処理中です。完了後に再度実行してください。")
         else:
             self.save_transitions_to_csv(self.transitions)
 
     def save_transitions_to_csv(self, transitions):
         image_directory = os.path.dirname(self.file_path)
         csv_file_path = os.path.join(image_directory, 'zahyou.csv')
-
-        with open(csv_file_path, mode='w', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow(['Index', 'X1', 'Y1', 'X2', 'Y2'])
-            
-            for index, (x1, y1, x2, y2) in transitions.items():
-                writer.writerow([index, x1, y1, x2, y2])
+        write_segments_csv(csv_file_path, transitions)
 
         messagebox.showinfo("完了", "csvファイル出力完了")  # ポップアップの表示
 
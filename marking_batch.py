@@ -0,0 +1,263 @@
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from marking_cache import DiskCache, file_digest
+from marking_engine import OUTPUT_FIELD, check_factor
+from marking_loader import open_for_processing
+from marking_pipeline import ImageProcessor
+from marking_stream import stream_to_csv
+from marking_writers import WRITERS
+from marking_profile import StageProfiler, append_jsonl, profile_call
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.gif', '.ppm', '.pgm')
+
+# 画像処理の設定の既定値
+DEFAULT_OPTIONS = {
+    'threshold': 30,
+    'factor': 10,
+    'cutoff_area': 100,
+    'reduced_decoding': False,  # JPEGをfactorに合わせて縮小デコードする
+    'stream': False,  # 帯ごとに処理してメモリ使用量を一定に保つ(csvのみ出力)
+    'formats': ('csv',),  # 座標ファイルの出力形式
+    'output_field': OUTPUT_FIELD,  # 出力座標系(回転角度, 短辺・長辺の長さ, 原点)
+    'fill_mode': 'rows',  # 'blocks'なら連続する行の同じ範囲の塗りを矩形ごとに続けて出力する、'hatch'なら輪郭の内側を平行線で塗る
+    'hatch_pitch': 0.1,  # hatchの線の間隔[出力座標の単位]
+    'hatch_angle': 0.0,  # hatchの線の角度[度]
+    'fill_order': 'raster',  # 'serpentine'なら行ごとに左右交互の向きで出力する
+    'contour_order': 'none',  # 輪郭の出力順('none'は検出順, 'nearest'は最も近い輪郭から, '2opt'はnearestをさらに改善)
+    'simplify_tolerance': 0.0,  # 輪郭の簡略化の許容誤差[出力座標の単位](0で簡略化しない)
+    'merge_collinear': True,  # 輪郭の同じ向きに続く線分を1本にまとめる
+    'polarity': 'black',  # 塗る側の色('black'または'white')
+    'coarsen_mode': 'nearest',  # 粗くする方法('nearest', 'area', 'majority')
+    'contours': True,  # 塗りに加えて輪郭も出力する(streamでは塗りだけを出力する)
+    'tile_workers': 1,  # 大きな画像1枚を行の帯に分けて処理するプロセス数
+    'cache_dir': None,  # 処理結果を保存し、同じ画像・設定の2回目以降は読み込むだけにするディレクトリ
+    'profile': False,  # 画像ごとにcProfile・tracemallocのレポート(<画像名>.profile.txt)を出力する
+    'profile_log': None,  # 画像ごとの工程別の記録を追記するJSON Linesファイルのパス
+}
+
+
+# 入力のディレクトリまたはglobパターンから画像ファイルを集める関数
+def collect_images(patterns):
+    image_paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            names = sorted(os.listdir(pattern))
+            candidates = [os.path.join(pattern, name) for name in names]
+        else:
+            candidates = sorted(glob.glob(pattern))
+        image_paths.extend(path for path in candidates
+                           if os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS))
+    return image_paths
+
+
+# 出力する座標ファイルのパスを決める関数
+def csv_path_for(image_path, output_dir=None, extension='csv'):
+    directory = output_dir or os.path.dirname(image_path)
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    return os.path.join(directory, f"{stem}.{extension}")
+
+
+# 画像1枚を処理してcsvファイルを出力する関数(ワーカープロセスで実行)
+# (出力ファイル, 線分数, 工程ごとの記録のリスト, 移動距離(並べ替え前, 並べ替え後)またはNone)を返す
+def process_file(image_path, output_dir, options):
+    options = {**DEFAULT_OPTIONS, **options}
+    profiler = StageProfiler(memory=options['profile'])
+    csv_file_path = csv_path_for(image_path, output_dir)
+    if options['stream']:
+        num_segments = profiler.measure('stream_to_csv', stream_to_csv, image_path, csv_file_path,
+                                        options['threshold'], options['factor'],
+                                        output_field=options['output_field'], polarity=options['polarity'])
+        return csv_file_path, num_segments, profiler.records, None
+
+    processor = make_processor(options)
+    if options['cache_dir']:
+        processor.result_cache = DiskCache(options['cache_dir'])
+        processor.image_digest = profiler.measure('file_digest', file_digest, image_path)
+
+    # デコードは切り出し範囲・必要な解像度に絞ってcrop_imageの中で行われる
+    image = profiler.measure('open_image', open_for_processing, image_path, options['factor'], options['reduced_decoding'])
+    with image:
+        processor.process_image(image)
+
+    output_paths = {output_format: csv_path_for(image_path, output_dir, output_format)
+                    for output_format in options['formats']}
+    num_segments = processor.export(output_paths)
+    profiler.records.extend(processor.profiler.records)
+    return ', '.join(output_paths.values()), num_segments, profiler.records, processor.travel
+
+
+# 設定からImageProcessorを作る関数
+def make_processor(options):
+    processor = ImageProcessor()
+    processor.set_parameters(options['threshold'], options['factor'], options['cutoff_area'])
+    # 左右反転し、粗い画像の画素単位の座標で出力する(1画素を1回の塗りにする)
+    processor.flip = True
+    processor.coarse_coordinates = True
+    processor.polarity = options['polarity']
+    processor.coarsen_mode = options['coarsen_mode']
+    processor.include_contours = options['contours']
+    processor.fill_mode = options['fill_mode']
+    processor.hatch_pitch = options['hatch_pitch']
+    processor.hatch_angle = options['hatch_angle']
+    processor.fill_order = options['fill_order']
+    processor.contour_order = options['contour_order']
+    processor.simplify_tolerance = options['simplify_tolerance']
+    processor.merge_collinear = options['merge_collinear']
+    processor.output_field = options['output_field']
+    processor.tile_workers = options['tile_workers']
+    processor.profiler.memory = options['profile']
+    return processor
+
+
+# cProfileとtracemallocのレポートを出力しながら画像1枚を処理する関数
+def profile_file(image_path, output_dir, options):
+    report_path = csv_path_for(image_path, output_dir, 'profile.txt')
+    return profile_call(report_path, process_file, image_path, output_dir, options)
+
+
+# 複数の画像を全コアで並列に処理する関数
+def run_batch(image_paths, output_dir=None, workers=None, **options):
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    options = {**DEFAULT_OPTIONS, **options}
+    process = profile_file if options['profile'] else process_file
+
+    summary = {'images': 0, 'segments': 0, 'failed': [], 'stage_times': {}, 'travel': None}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(process, path, output_dir, options): path
+            for path in image_paths
+        }
+        for future in as_completed(futures):
+            image_path = futures[future]
+            try:
+                csv_file_path, num_segments, records, travel = future.result()
+            except Exception as error:
+                summary['failed'].append((image_path, repr(error)))
+                print(f"失敗: {image_path}: {error}", file=sys.stderr)
+                continue
+            summary['images'] += 1
+            summary['segments'] += num_segments
+            if travel is not None:
+                before, after = summary['travel'] or (0.0, 0.0)
+                summary['travel'] = (before + travel[0], after + travel[1])
+            for record in records:
+                stage = record['stage']
+                summary['stage_times'][stage] = summary['stage_times'].get(stage, 0.0) + record['seconds']
+            if options['profile_log']:
+                append_jsonl(options['profile_log'], {'image': image_path, 'output': csv_file_path,
+                                                      'segments': num_segments, 'stages': records})
+            print(f"{image_path} -> {csv_file_path} ({num_segments}行)")
+
+    summary['elapsed'] = time.perf_counter() - start
+    return summary
+
+
+# 処理結果の集計を表示する関数
+def print_summary(summary, file=sys.stdout):
+    elapsed = summary['elapsed']
+    rate = summary['images'] / elapsed if elapsed > 0 else 0.0
+    print(f"完了: {summary['images']}枚 / 失敗: {len(summary['failed'])}枚 / "
+          f"{elapsed:.2f}秒 ({rate:.2f}枚/秒) / 合計{summary['segments']}行", file=file)
+    if summary['travel'] is not None:
+        print(f"移動距離の合計(並べ替え前→後): {summary['travel'][0]:.1f}→{summary['travel'][1]:.1f}", file=file)
+    if summary['images']:
+        print("工程別の平均処理時間:", file=file)
+        for stage, seconds in summary['stage_times'].items():
+            print(f"  {stage:<24} {seconds / summary['images'] * 1000:10.1f} ms", file=file)
+
+
+# しきい値の引数を解釈する関数('auto'なら大津の方法で自動決定)
+def parse_threshold(value):
+    return None if value.lower() in ('auto', 'otsu') else int(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="画像をまとめて処理し、画像ごとにcsvファイルを出力する")
+    parser.add_argument('inputs', nargs='+', help="画像のディレクトリまたはglobパターン")
+    parser.add_argument('-o', '--output-dir', help="csvの出力先(省略時は画像と同じディレクトリ)")
+    parser.add_argument('--threshold', type=parse_threshold, default=30, help="2値化のしきい値('auto'で自動決定)")
+    parser.add_argument('--factor', type=float, default=10,
+                        help="粗くする倍率(--coarsen area・majorityでは2.5などの小数も指定できる)")
+    parser.add_argument('--cutoff', type=int, default=100)
+    parser.add_argument('-j', '--workers', type=int, default=None, help="ワーカープロセス数(省略時はCPUコア数)")
+    parser.add_argument('--reduced-decode', action='store_true',
+                        help="JPEGをfactorに合わせて縮小デコードする(高速だが細い線が消えることがある)")
+    parser.add_argument('--stream', action='store_true', help="帯ごとに処理してメモリ使用量を一定に保つ(巨大な画像向け)")
+    parser.add_argument('--angle', type=float, default=OUTPUT_FIELD['angle'], help="出力座標の回転角度[度]")
+    parser.add_argument('--field', type=float, nargs=2, default=OUTPUT_FIELD['field'], metavar=('SHORT', 'LONG'),
+                        help="短辺・長辺を合わせる長さ")
+    parser.add_argument('--origin', type=float, nargs=2, default=OUTPUT_FIELD['origin'], metavar=('X', 'Y'),
+                        help="原点のオフセット")
+    parser.add_argument('--fill-mode', choices=('rows', 'blocks', 'hatch'), default='rows',
+                        help="塗りの出力方法(blocksは連続する行の同じ範囲を矩形にまとめ、矩形ごとに続けて1行ずつ出力する、"
+                             "hatchは輪郭(穴を含む)の内側を出力座標で一定の間隔の平行線で塗る)")
+    parser.add_argument('--hatch-pitch', type=float, default=0.1, help="hatchの線の間隔[出力座標の単位]")
+    parser.add_argument('--hatch-angle', type=float, default=0.0, help="hatchの線の角度[度]")
+    parser.add_argument('--coarsen', choices=('nearest', 'area', 'majority'), default='nearest',
+                        help="粗くする方法(areaはブロック平均を2値化、majorityはブロックごとの多数決)")
+    parser.add_argument('--polarity', choices=('black', 'white'), default='black', help="塗る側の色")
+    parser.add_argument('--fill-order', choices=('raster', 'serpentine'), default='raster',
+                        help="塗りの出力順(serpentineは行ごとに左右交互にしてヘッドの戻りを減らす)")
+    parser.add_argument('--contour-order', choices=('none', 'nearest', '2opt'), default='none',
+                        help="輪郭の出力順(nearestは最も近い輪郭から、2optはnearestをさらに改善してヘッドの移動を減らす)")
+    parser.add_argument('--simplify', type=float, default=0.0, metavar='TOL',
+                        help="輪郭をDouglas-Peuckerで簡略化する許容誤差[出力座標の単位](0で簡略化しない)")
+    parser.add_argument('--no-merge-collinear', dest='merge_collinear', action='store_false',
+                        help="輪郭の同じ向きに続く線分を1本にまとめない")
+    parser.add_argument('--tile-workers', type=int, default=1,
+                        help="大きな画像(8メガピクセル以上)1枚を行の帯に分けて処理するプロセス数(巨大な画像を-j1で処理する場合に使う)")
+    parser.add_argument('--cache-dir',
+                        help="処理結果を保存するディレクトリ(同じ画像・設定の2回目以降は保存した結果を出力する。--streamでは使わない)")
+    parser.add_argument('--no-contours', dest='contours', action='store_false',
+                        help="塗りだけを出力する(--streamでは常に塗りだけを出力する)")
+    parser.add_argument('--profile', action='store_true',
+                        help="画像ごとにcProfile・tracemallocのレポート(<画像名>.profile.txt)を出力する")
+    parser.add_argument('--profile-log', help="画像ごとの工程別の処理時間・ピークメモリ・出力の大きさを追記するJSON Linesファイル")
+    parser.add_argument('--format', default='csv',
+                        help=f"座標ファイルの出力形式をカンマ区切りで指定する({', '.join(WRITERS)})")
+    args = parser.parse_args(argv)
+
+    formats = tuple(name.strip().lower() for name in args.format.split(',') if name.strip())
+    unknown = [name for name in formats if name not in WRITERS]
+    if unknown or not formats:
+        parser.error(f"未対応の出力形式です: {', '.join(unknown)}")
+    if args.stream and formats != ('csv',):
+        parser.error("--streamではcsv形式のみ出力できます。")
+    if args.stream and (args.fill_mode != 'rows' or args.fill_order != 'raster' or args.coarsen != 'nearest'):
+        parser.error("--streamでは--fill-mode rows, --fill-order raster, --coarsen nearestのみ使用できます。")
+    if args.hatch_pitch <= 0:
+        parser.error("--hatch-pitchは0より大きい値を指定してください。")
+    if args.simplify < 0:
+        parser.error("--simplifyは0以上の値を指定してください。")
+    try:
+        args.factor = check_factor(args.factor, args.coarsen)
+    except ValueError as error:
+        parser.error(str(error))
+
+    image_paths = collect_images(args.inputs)
+    if not image_paths:
+        parser.error("画像が見つかりません。")
+
+    summary = run_batch(image_paths, args.output_dir, args.workers, threshold=args.threshold, factor=args.factor,
+                        cutoff_area=args.cutoff, reduced_decoding=args.reduced_decode, stream=args.stream,
+                        formats=formats, fill_mode=args.fill_mode, fill_order=args.fill_order,
+                        contour_order=args.contour_order, simplify_tolerance=args.simplify,
+                        merge_collinear=args.merge_collinear,
+                        hatch_pitch=args.hatch_pitch, hatch_angle=args.hatch_angle,
+                        polarity=args.polarity, coarsen_mode=args.coarsen, contours=args.contours, profile=args.profile,
+                        tile_workers=args.tile_workers, cache_dir=args.cache_dir,
+                        profile_log=args.profile_log,
+                        output_field={'angle': args.angle, 'field': args.field, 'origin': args.origin})
+    print_summary(summary)
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
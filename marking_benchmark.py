@@ -0,0 +1,215 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from marking_pipeline import ImageProcessor
+
+# 画像の種類
+KINDS = ('text', 'logo', 'photo')
+# 画像の大きさ[メガピクセル](既定では小さい方だけ、--fullで全て測る)
+SIZES = (1, 4, 16, 50, 100)
+QUICK_SIZES = (1, 4)
+# 縦横比(1.5はcrop_imageで長辺を切る側、3.0は短辺の2倍に切る側の分岐を通る)
+ASPECTS = (1.5, 3.0)
+# (factor, threshold)の組み合わせ(thresholdがNoneなら大津の方法)
+SETTINGS = ((10, 30), (5, 128), (10, None))
+STAGES = ('process_image', 'extract_contours', 'export_csv')
+CUTOFF_AREA = 100
+# 模様を描く解像度の上限(これより大きい画像は拡大して作る)
+DESIGN_PIXELS = 2 ** 22
+
+
+# 画像の幅と高さを求める関数(横長にする)
+def image_size(megapixels, aspect):
+    height = int(round((megapixels * 1e6 / aspect) ** 0.5))
+    return int(round(height * aspect)), height
+
+
+# 文字の並びのような画像を作る関数(5x7のランダムな字形を行単位で並べる)
+def text_pattern(width, height, rng):
+    columns, rows = max(1, width // 12), max(1, height // 20)
+    glyphs = rng.random((rows, columns, 7, 5)) < 0.45
+    glyphs[rng.random((rows, columns)) < 0.15] = False  # 単語の区切り
+    cells = np.zeros((rows, columns, 10, 6), dtype=bool)
+    cells[:, :, 1:8, :5] = glyphs
+    bitmap = cells.transpose(0, 2, 1, 3).reshape(rows * 10, columns * 6)
+    return np.where(bitmap, 0, 255).astype(np.uint8)
+
+
+# 同心円と放射状の帯を組み合わせたロゴのような画像を作る関数
+def logo_pattern(width, height, rng):
+    y, x = np.ogrid[:height, :width]
+    cx, cy = width * rng.uniform(0.4, 0.6), height * rng.uniform(0.4, 0.6)
+    radius = np.hypot(x - cx, y - cy) / min(width, height)
+    angle = np.arctan2(y - cy, x - cx)
+    rings = (radius * 12 % 1 < 0.45) & (radius < 0.45)
+    spokes = (np.sin(angle * 8) > 0.6) & (radius > 0.2) & (radius < 0.6)
+    return np.where(rings ^ spokes, 0, 255).astype(np.uint8)
+
+
+# なめらかな濃淡の写真のような画像を作る関数(ノイズは拡大後に加える)
+def photo_pattern(width, height, rng):
+    field = rng.random((max(2, height // 64), max(2, width // 64))) * 255
+    return np.asarray(Image.fromarray(field.astype(np.uint8)).resize((width, height), Image.BICUBIC))
+
+
+PATTERNS = {'text': text_pattern, 'logo': logo_pattern, 'photo': photo_pattern}
+
+
+# 合成画像を作る関数(大きな画像は模様を拡大し、写真は行の帯ごとにノイズを加える)
+def synthetic_image(kind, megapixels, aspect, seed=0, noise=24):
+    rng = np.random.default_rng(seed)
+    width, height = image_size(megapixels, aspect)
+    scale = max(1.0, (width * height / DESIGN_PIXELS) ** 0.5)
+    design = PATTERNS[kind](max(1, int(width / scale)), max(1, int(height / scale)), rng)
+    resample = Image.BILINEAR if kind == 'photo' else Image.NEAREST
+    pixels = np.array(Image.fromarray(design).resize((width, height), resample))
+    if kind == 'photo':
+        for top in range(0, height, 1024):
+            band = pixels[top:top + 1024]
+            band[:] = np.clip(band + rng.integers(-noise, noise + 1, band.shape, dtype=np.int16), 0, 255)
+    return Image.fromarray(pixels).convert('RGB')
+
+
+# 関数を繰り返し実行して最短の処理時間[秒]と結果を返す関数
+def best_time(repeat, function, *args):
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+# 1つの画像と設定で各工程を測定する関数(process_imageは輪郭の抽出を含む)
+def run_case(image, factor, threshold, repeat, csv_file_path):
+    processor = ImageProcessor()
+    processor.set_parameters(threshold, factor, CUTOFF_AREA)
+    process_time, contour_time = None, None
+    for _ in range(repeat):
+        elapsed, _ = best_time(1, processor.process_image, image)
+        timings = processor.timings
+        contours = timings['extract_contours'] + timings['flatten_contours']
+        process_time = elapsed if process_time is None else min(process_time, elapsed)
+        contour_time = contours if contour_time is None else min(contour_time, contours)
+    export_time, num_segments = best_time(repeat, processor.export, {'csv': csv_file_path})
+    return {
+        'seconds': {'process_image': process_time, 'extract_contours': contour_time, 'export_csv': export_time},
+        'segments': num_segments,
+    }
+
+
+# 測定条件を表す名前を作る関数
+def case_name(kind, megapixels, aspect, factor, threshold):
+    threshold = 'auto' if threshold is None else threshold
+    return f"{kind}-{megapixels}MP-{aspect}:1-f{factor}-t{threshold}"
+
+
+# 全ての条件で測定する関数
+def run_benchmark(kinds=KINDS, sizes=QUICK_SIZES, aspects=ASPECTS, settings=SETTINGS, repeat=3):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        csv_file_path = os.path.join(directory, 'zahyou.csv')
+        for kind in kinds:
+            for megapixels in sizes:
+                for aspect in aspects:
+                    image = synthetic_image(kind, megapixels, aspect)
+                    for factor, threshold in settings:
+                        name = case_name(kind, megapixels, aspect, factor, threshold)
+                        result = run_case(image, factor, threshold, repeat, csv_file_path)
+                        result['megapixels'] = image.width * image.height / 1e6
+                        results[name] = result
+                        print(format_result(name, result), flush=True)
+                    image.close()
+    return {'environment': environment(), 'repeat': repeat, 'results': results}
+
+
+# 測定環境を記録する関数(比較時に環境の違いを警告する)
+def environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'system': platform.system(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+# 工程ごとのスループット[メガピクセル/秒]を求める関数
+def throughput(result, stage):
+    seconds = result['seconds'][stage]
+    return result['megapixels'] / seconds if seconds > 0 else float('inf')
+
+
+# 1つの条件の測定結果を1行の文字列にする関数
+def format_result(name, result):
+    stages = ", ".join(f"{stage} {result['seconds'][stage] * 1000:8.1f}ms ({throughput(result, stage):7.1f}MP/s)"
+                       for stage in STAGES)
+    return f"{name:<34} {stages} / {result['segments']}行"
+
+
+# 基準の測定結果と比較し、スループットが許容範囲を超えて下がった(条件, 工程, 比)のリストを返す関数
+def compare(baseline, current, tolerance):
+    regressions = []
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            continue
+        for stage in STAGES:
+            ratio = throughput(result, stage) / throughput(baseline['results'][name], stage)
+            print(f"  {name:<34} {stage:<18} {ratio:6.2f}x")
+            if ratio < 1 - tolerance:
+                regressions.append((name, stage, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="合成画像で画像処理・輪郭抽出・csv出力の処理速度を測定する")
+    parser.add_argument('--kinds', nargs='+', choices=KINDS, default=KINDS, help="画像の種類")
+    parser.add_argument('--sizes', nargs='+', type=int, default=None, help="画像の大きさ[メガピクセル]")
+    parser.add_argument('--full', action='store_true', help=f"全ての大きさ({', '.join(map(str, SIZES))}MP)で測定する")
+    parser.add_argument('--repeat', type=int, default=3, help="各工程の繰り返し回数(最短の時間を採用する)")
+    parser.add_argument('--save', help="測定結果を保存するJSONファイル(基準として使う)")
+    parser.add_argument('--compare', help="比較する基準のJSONファイル")
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help="許容するスループットの低下率(既定0.15なら基準の85%%未満で失敗)")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            baseline = json.load(file)
+
+    sizes = args.sizes or (SIZES if args.full else QUICK_SIZES)
+    current = run_benchmark(args.kinds, sizes, repeat=args.repeat)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as file:
+            json.dump(current, file, ensure_ascii=False, indent=2)
+        print(f"保存しました: {args.save}")
+
+    if baseline is None:
+        return 0
+    if baseline.get('environment') != current['environment']:
+        print("警告: 基準と測定環境が異なります。", baseline.get('environment'), file=sys.stderr)
+    print(f"基準との比較(スループットの比, 許容 {1 - args.tolerance:.2f}x 以上):")
+    regressions = compare(baseline, current, args.tolerance)
+    if not set(current['results']) & set(baseline['results']):
+        print("基準と共通の測定条件がありません。", file=sys.stderr)
+        return 1
+    for name, stage, ratio in regressions:
+        print(f"低下: {name} {stage} {ratio:.2f}x", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+import hashlib
+import os
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+# ディスクキャッシュの保存形式のバージョン(保存する内容を変えたら上げて古いファイルを使わないようにする)
+DISK_CACHE_VERSION = 1
+# GUIが処理結果を保存するディレクトリ
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ddl_marking')
+
+
+# ファイル内容のダイジェストを求める関数
+def file_digest(file_path, chunk_size=1 << 20):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# キャッシュする値のおおよそのメモリ使用量を見積もる関数
+def estimate_size(value):
+    if isinstance(value, Image.Image):
+        width, height = value.size
+        return width * height * len(value.getbands())
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return 64 * len(value) + sum(estimate_size(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return 8 * len(value) + sum(estimate_size(item) for item in value)
+    return 64
+
+
+class StageCache:
+    # 工程ごとの処理結果を(画像ダイジェスト, 工程名, パラメータ)のキーで保持するLRUキャッシュ
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()  # 本処理とライブプレビューのスレッドから共有される
+
+    # キャッシュから取得し、なければ計算して保存する関数
+    def get_or_compute(self, key, compute):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+
+        value = compute()
+        self.put(key, value)
+        return value
+
+    # 値を保存し、上限を超えた分を古い順に捨てる関数
+    def put(self, key, value):
+        size = estimate_size(value)
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+
+class DiskCache:
+    # 処理結果(座標の配列・プレビュー画像)をファイルに保存し、次回以降の起動でも再利用するキャッシュ
+    # (キーは画像ファイルのダイジェストと処理のパラメータから作り、合計サイズがmax_bytesを超えたら古い順に削除する)
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    # キー(ダイジェストとパラメータのタプル)をファイル名に変換する関数
+    def path_for(self, key, extension):
+        name = hashlib.blake2b(repr((DISK_CACHE_VERSION,) + tuple(key)).encode(), digest_size=16).hexdigest()
+        return os.path.join(self.directory, f"{name}.{extension}")
+
+    # 保存された配列の辞書を読み込む関数(なければNone)
+    def load_arrays(self, key):
+        return self.load(self.path_for(key, 'npz'), lambda file: dict(np.load(file, allow_pickle=False)))
+
+    # 配列の辞書を圧縮して保存する関数
+    def save_arrays(self, key, arrays):
+        self.save(self.path_for(key, 'npz'), lambda file: np.savez_compressed(file, **arrays))
+
+    # キャッシュファイルを読み込み、最近使ったものとして更新時刻を更新する関数
+    def load(self, file_path, read):
+        try:
+            with open(file_path, 'rb') as file:
+                value = read(file)
+            os.utime(file_path)
+        except (OSError, ValueError, zipfile.BadZipFile):
+            # 存在しない・他のプロセスが削除した・壊れたファイルは計算し直す
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return value
+
+    # 一時ファイルに書いてから置き換え、書きかけのファイルを読まないようにする関数
+    def save(self, file_path, write):
+        descriptor, temporary_path = tempfile.mkstemp(prefix='.part-', dir=self.directory)
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                write(file)
+            os.replace(temporary_path, file_path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+        self.evict()
+
+    # 合計サイズが上限を超えた分を、使われていない期間が長い順に削除する関数
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.part-') or not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, file_path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+            total_bytes -= size
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                os.remove(entry.path)
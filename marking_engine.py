@@ -0,0 +1,414 @@
+import csv
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+
+# 画像を2:1にトリミングする範囲を求める関数
+def crop_box(size):
+    width, height = size
+
+    long_side = max(width, height)
+    short_side = min(width, height)
+    if short_side * 2 > long_side:
+        new_height = long_side // 2 if height == short_side else height
+        new_width = long_side // 2 if width == short_side else width
+    else:
+        new_height = short_side if height == short_side else short_side * 2
+        new_width = short_side if width == short_side else short_side * 2
+    left = (width - new_width) / 2
+    top = (height - new_height) / 2
+    right = (width + new_width) / 2
+    bottom = (height + new_height) / 2
+    return (left, top, right, bottom)
+
+
+# 非圧縮で1行ずつ並んだ画像のファイル内の配置(先頭位置, 1行のバイト数)を返す関数
+def raw_layout(image):
+    tiles = getattr(image, 'tile', None)
+    if not tiles or len(tiles) != 1 or image.mode not in ('L', 'RGB'):
+        return None
+    codec, extents, offset, args = tiles[0]
+    width, height = image.size
+    stride = width * len(image.mode)
+    raw_args = (args, 0, 1) if isinstance(args, str) else tuple(args)
+    if (codec == 'raw' and tuple(extents) == (0, 0, width, height)
+            and len(raw_args) == 3 and raw_args[0] == image.mode and raw_args[1] in (0, stride) and raw_args[2] == 1):
+        return offset, stride
+    return None
+
+
+# 切り出す範囲にかかる部分だけをデコードする関数
+def load_region(image, box):
+    tiles = getattr(image, 'tile', None)
+    if not tiles:
+        return  # 読み込み済み、またはファイル由来でない画像
+    width, height = image.size
+    left, top, right, bottom = box
+    top, bottom = int(top), min(height, math.ceil(bottom))
+
+    if len(tiles) > 1:
+        # タイル・ストリップ分割された画像は範囲にかかるものだけを残す
+        image.tile = [tile for tile in tiles
+                      if tile[1][0] < right and tile[1][2] > left and tile[1][1] < bottom and tile[1][3] > top]
+        return
+
+    # 非圧縮RGBは範囲の行だけを読むように開始位置をずらす('L'はPILがメモリマップで読むため不要)
+    layout = raw_layout(image)
+    if layout and image.mode == 'RGB':
+        offset, stride = layout
+        codec, _, _, args = tiles[0]
+        image.tile = [(codec, (0, top, width, bottom), offset + top * stride, args)]
+
+
+# グレースケールに変換してから切り出す関数(カラーの切り出し画像を作らない)
+def crop_grayscale(image, box):
+    load_region(image, box)
+    grayscale_image = image if image.mode == 'L' else image.convert('L')
+    return grayscale_image.crop(box)
+
+
+# ヒストグラムから大津の方法でしきい値を求める関数
+def otsu_threshold(histogram):
+    counts = np.asarray(histogram[:256], dtype=np.float64)
+    levels = np.arange(256)
+    weight_dark = np.cumsum(counts)
+    weight_light = weight_dark[-1] - weight_dark
+    sum_dark = np.cumsum(counts * levels)
+    mean_dark = sum_dark / np.maximum(weight_dark, 1)
+    mean_light = (sum_dark[-1] - sum_dark) / np.maximum(weight_light, 1)
+    between_variance = weight_dark * weight_light * (mean_dark - mean_light) ** 2
+    return int(np.argmax(between_variance))
+
+
+# グレースケール画像を2値化し、白のブール配列と使用したしきい値を返す関数
+def binarize_mask(grayscale_image, threshold=None):
+    if threshold is None:
+        threshold = otsu_threshold(grayscale_image.histogram())
+    return np.asarray(grayscale_image) > threshold, threshold
+
+
+# 二値画像を黒画素のブール配列に変換する関数
+def black_mask(image):
+    pixels = np.asarray(image)
+    if pixels.dtype == np.bool_:
+        return ~pixels
+    return pixels == 0
+
+
+# 塗りつぶしの座標を(N, 4)のint32配列として抽出する関数
+# (polarityは塗る側の色('black'または'white')、workersが2以上なら行を分けて並列に処理する)
+def extract_runs(image, polarity='black', workers=1):
+    mark = black_mask(image)
+    if polarity == 'white':
+        mark = ~mark
+    elif polarity != 'black':
+        raise ValueError(f"polarityは'black'または'white'です: {polarity}")
+
+    height = mark.shape[0]
+    if workers <= 1 or height < 2 * workers:
+        return mask_runs(mark)
+
+    # 差分・検出はNumPyの中でGILを解放するため、行の帯ごとにスレッドで並列に処理する
+    bounds = np.linspace(0, height, workers + 1).astype(int)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        chunks = list(executor.map(lambda top, bottom: mask_runs(mark[top:bottom], top), bounds[:-1], bounds[1:]))
+    return np.concatenate(chunks)
+
+
+# 塗る画素の2次元マスクから行ごとの塗りを抽出する関数(y_offsetは帯の先頭行)
+def mask_runs(mark, y_offset=0):
+    height, width = mark.shape
+
+    # 左右に塗らない列を足して差分を取り、塗りの開始(+1)と終了(-1)を行ごとに検出する
+    # (右端まで続く塗りも右側に足した列で終了し、終点のXは画像の幅になる)
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = mark
+    edges = np.diff(padded, axis=1)
+
+    # 変化のある位置を1回だけ走査し、符号で開始と終了に分ける
+    positions = np.flatnonzero(edges)
+    signs = edges.ravel()[positions]
+    start_y, start_x = np.divmod(positions[signs == 1], width + 1)
+    end_x = positions[signs == -1] % (width + 1)
+
+    runs = np.empty((len(start_x), 4), dtype=np.int32)
+    runs[:, 0] = start_x
+    runs[:, 1] = start_y + y_offset
+    runs[:, 2] = end_x
+    runs[:, 3] = runs[:, 1]
+    return runs
+
+
+# 座標配列を従来の辞書形式に変換する関数
+def runs_to_dict(runs, start_index=0):
+    return {start_index + i: tuple(row) for i, row in enumerate(runs.tolist())}
+
+
+# NEARESTでの拡大・縮小後の各画素が参照する元の画素の位置を求める関数
+def nearest_source(source_length, target_length):
+    # 添字を画素値に持つ1行の画像を実際に拡大・縮小し、PILと同じ対応関係を得る
+    index_image = Image.fromarray(np.arange(source_length, dtype=np.int32)[None, :])
+    return np.asarray(index_image.resize((target_length, 1), Image.NEAREST))[0]
+
+
+# NEAREST拡大で各粗い画素が元画像上で始まる位置を求める関数
+def nearest_edges(coarse_length, full_length):
+    source = nearest_source(coarse_length, full_length)
+    return np.searchsorted(source, np.arange(coarse_length + 1))
+
+
+# 粗い画像上の座標を拡大後の画像上の座標に変換する関数
+# (edgesを指定した場合は、ブロックごとに粗くした画像の各ブロックの境界を使う)
+def expand_runs(runs, coarse_size, full_size, edges=None):
+    if edges is None:
+        edges = (nearest_edges(coarse_size[0], full_size[0]), nearest_edges(coarse_size[1], full_size[1]))
+    col_edges, row_edges = edges
+
+    # 粗い1行は拡大後の複数行に対応するため、行ごとに同じ塗りを繰り返す
+    coarse_y = runs[:, 1]
+    repeats = np.diff(row_edges)[coarse_y]
+    source = np.repeat(np.arange(len(runs)), repeats)
+    first = np.cumsum(repeats) - repeats
+    offsets = np.arange(len(source)) - np.repeat(first, repeats)
+    full_y = row_edges[coarse_y[source]] + offsets
+    order = np.argsort(full_y, kind='stable')
+    source = source[order]
+
+    expanded = np.empty((len(source), 4), dtype=np.int32)
+    expanded[:, 0] = col_edges[runs[source, 0]]
+    expanded[:, 1] = full_y[order]
+    expanded[:, 2] = col_edges[runs[source, 2]]
+    expanded[:, 3] = expanded[:, 1]
+    return expanded
+
+
+# 粗くする倍率を確かめ、整数の値はintにして返す関数(nearestは整数のみ、area・majorityは1以上の小数も使える)
+def check_factor(factor, mode='nearest'):
+    if not factor >= 1:
+        raise ValueError(f"factorは1以上を指定してください: {factor}")
+    if float(factor).is_integer():
+        return int(factor)
+    if mode == 'nearest':
+        raise ValueError(f"nearestで粗くする場合のfactorは整数で指定してください(小数はarea・majorityのみ): {factor}")
+    return float(factor)
+
+
+# 粗くする際のブロックの境界を求める関数(非整数の倍率にも対応し、端の余りの画素は最後のブロックとして残す)
+def block_edges(length, factor):
+    count = max(1, math.ceil(length / factor))
+    edges = np.minimum(np.round(np.arange(count + 1) * factor), length).astype(np.int64)
+    edges[-1] = length
+    return np.unique(edges)
+
+
+# ブロックごとの画素値の合計と画素数を求める関数
+def block_sums(pixels, col_edges, row_edges):
+    pixels = pixels.view(np.uint8) if pixels.dtype == np.bool_ else pixels
+    widths, heights = np.diff(col_edges), np.diff(row_edges)
+
+    # 合計が収まる範囲で小さい型を使う(列方向を先に畳むと速い)
+    largest = int(np.iinfo(pixels.dtype).max) * int(widths.max()) * int(heights.max())
+    dtype = np.uint16 if largest <= np.iinfo(np.uint16).max else np.uint32
+    sums = axis_block_sums(pixels, col_edges, 1, dtype)
+    sums = axis_block_sums(sums, row_edges, 0, dtype)
+    return sums, np.outer(heights, widths)
+
+
+# 1つの軸に沿ってブロックごとの合計を求める関数
+def axis_block_sums(pixels, edges, axis, dtype):
+    sizes = np.diff(edges)
+    step = int(sizes[0])
+    if len(sizes) > 1 and not (sizes[:-1] == step).all():
+        return np.add.reduceat(pixels, edges[:-1], axis=axis, dtype=dtype)
+
+    # 整数倍のブロックは、ブロック内のi番目の画素をまとめて足し合わせる方が速い
+    shape = list(pixels.shape)
+    shape[axis] = len(sizes)
+    sums = np.zeros(shape, dtype=dtype)
+    for i in range(step):
+        part = pixels[:, i::step] if axis == 1 else pixels[i::step]
+        if axis == 1:
+            sums[:, :part.shape[1]] += part
+        else:
+            sums[:part.shape[0]] += part
+    return sums
+
+
+# グレースケール画像をブロックの平均で縮小してから2値化し、白のブール配列で返す関数
+def coarsen_area(grayscale_image, factor, threshold):
+    width, height = grayscale_image.size
+    edges = (block_edges(width, factor), block_edges(height, factor))
+    if float(factor).is_integer():
+        # 整数倍ならPILのreduceで平均を求める(余りの画素は端のブロックで平均される)
+        return np.asarray(grayscale_image.reduce(int(factor))) > threshold, edges
+    sums, counts = block_sums(np.asarray(grayscale_image), *edges)
+    return sums > threshold * counts, edges
+
+
+# 2値化画像(白のブール配列)のブロックごとに多数決で白黒を決める関数(同数の場合は黒)
+def coarsen_majority(white, factor):
+    white = binary_array(white)
+    height, width = white.shape
+    edges = (block_edges(width, factor), block_edges(height, factor))
+    sums, counts = block_sums(white, *edges)
+    return 2 * sums.astype(np.int64) > counts, edges
+
+
+# 2値化画像(白のブール配列)をNEARESTと同じ画素の選び方で粗くする関数
+def coarsen_nearest(white, factor):
+    factor = check_factor(factor, 'nearest')
+    white = binary_array(white)
+    height, width = white.shape
+    coarse_width, coarse_height = max(1, width // factor), max(1, height // factor)
+    rows, columns = nearest_source(height, coarse_height), nearest_source(width, coarse_width)
+    edges = (nearest_edges(coarse_width, width), nearest_edges(coarse_height, height))
+    return white[np.ix_(rows, columns)], edges
+
+
+# 2値化画像を白のブール配列に変換する関数
+def binary_array(image):
+    pixels = np.asarray(image)
+    if pixels.dtype != np.bool_:
+        return pixels > 0
+    if isinstance(image, Image.Image):
+        # PILの'1'画像から得た配列は白が1ではなく255のバイトで入っており、合計が255倍になるため0/1に直す
+        return pixels.view(np.uint8) > 0
+    return pixels
+
+
+# ブロックごとに粗くした配列を元のサイズに戻す関数
+def expand_blocks(pixels, edges):
+    col_edges, row_edges = edges
+    columns = np.repeat(np.arange(len(col_edges) - 1), np.diff(col_edges))
+    rows = np.repeat(np.arange(len(row_edges) - 1), np.diff(row_edges))
+    return pixels[np.ix_(rows, columns)]
+
+
+# 粗い格子上の点の座標を、対応するブロックの中央の元画像上の座標に変換する関数
+def coarse_points_to_full(points, edges):
+    col_edges, row_edges = edges
+    col_centers = (col_edges[:-1] + col_edges[1:] - 1) // 2
+    row_centers = (row_edges[:-1] + row_edges[1:] - 1) // 2
+    full = np.empty_like(points)
+    full[..., 0] = col_centers[points[..., 0]]
+    full[..., 1] = row_centers[points[..., 1]]
+    return full
+
+
+# OpenCVの輪郭を隣り合う点を結ぶ(N, 4)のint32配列に変換する関数(closedなら終点から始点に戻る線分も含める)
+def contour_segments(contours, closed=False):
+    lengths = np.array([len(contour) for contour in contours], dtype=np.int64)
+    if not lengths.sum():
+        return np.empty((0, 4), dtype=np.int32)
+    points = np.concatenate([contour.reshape(-1, 2) for contour in contours]).astype(np.int32)
+
+    # 各点の次の点の位置(輪郭の最後の点は、閉じる場合だけ同じ輪郭の最初の点につなぐ)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    following = np.arange(1, len(points) + 1)
+    following[ends[lengths > 0] - 1] = starts[lengths > 0]
+    keep = np.ones(len(points), dtype=bool)
+    if not closed:
+        keep[ends[lengths > 0] - 1] = False
+    keep[starts[lengths == 1]] = False  # 1点だけの輪郭は線分にならない
+
+    return np.hstack([points[keep], points[following[keep]]])
+
+
+# 始点が直前の線分の終点と一致し、同じ向きに続く線分を1本にまとめる関数
+def merge_collinear_segments(segments):
+    if len(segments) < 2:
+        return segments
+    segments = np.asarray(segments)
+    direction = (segments[:, 2:] - segments[:, :2]).astype(np.int64)
+    previous, current = direction[:-1], direction[1:]
+    cross = previous[:, 0] * current[:, 1] - previous[:, 1] * current[:, 0]
+    dot = (previous * current).sum(axis=1)
+    connected = (segments[:-1, 2:] == segments[1:, :2]).all(axis=1)
+
+    # 前の線分に続けられない線分から新しいまとまりを始める
+    starts = np.concatenate([[True], ~(connected & (cross == 0) & (dot > 0))])
+    first = np.flatnonzero(starts)
+    last = np.append(first[1:], len(segments)) - 1
+    return np.hstack([segments[first, :2], segments[last, 2:]])
+
+
+# 連続する行の同じ範囲の塗りを矩形(x1, 上端のy, x2, 下端のy)にまとめる関数
+def merge_runs_into_blocks(runs):
+    if len(runs) < 2:
+        return runs
+    runs = np.asarray(runs)
+
+    # 同じ範囲の塗りを行順に並べ、1行ずつ続いている間は同じ矩形とする
+    order = np.lexsort((runs[:, 1], runs[:, 2], runs[:, 0]))
+    ordered = runs[order]
+    same_span = (ordered[1:, 0] == ordered[:-1, 0]) & (ordered[1:, 2] == ordered[:-1, 2])
+    starts = np.concatenate([[True], ~(same_span & (ordered[1:, 1] == ordered[:-1, 3] + 1))])
+    first = np.flatnonzero(starts)
+    last = np.append(first[1:], len(ordered)) - 1
+    blocks = np.column_stack([ordered[first, 0], ordered[first, 1], ordered[last, 2], ordered[last, 3]])
+
+    # 元と同じく上の行・左の塗りから順に出力する
+    return blocks[np.lexsort((blocks[:, 0], blocks[:, 1]))].astype(runs.dtype)
+
+
+# 出力座標系の既定値(回転角度[度], 回転後のX・Yを合わせる長さ(短辺, 長辺), 原点のオフセット)
+OUTPUT_FIELD = {'angle': 90, 'field': (20, 40), 'origin': (10, -20)}
+
+
+# 回転・縮尺・オフセットを求める関数(回転後のXを短辺、Yを長辺に合わせる)
+def output_transform(size, angle=90, field=(20, 40), origin=(10, -20)):
+    width, height = size
+    scale = (field[0] / min(width, height), field[1] / max(width, height))
+    return {'angle': angle, 'scale': scale, 'offset': tuple(origin)}
+
+
+# 回転・縮尺・オフセットをまとめた3x3のアフィン行列を作る関数
+def output_matrix(size, angle=90, field=(20, 40), origin=(10, -20)):
+    return scale_offset_matrix(size, field, origin) @ rotation_matrix(angle)
+
+
+# 原点を中心に回転する3x3の行列を作る関数
+def rotation_matrix(angle=90):
+    # 90度単位の回転は誤差が出ないように整数で持つ
+    if angle % 90 == 0:
+        cos, sin = [(1, 0), (0, 1), (-1, 0), (0, -1)][int(angle // 90) % 4]
+    else:
+        cos, sin = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+    return np.array([[cos, -sin, 0], [sin, cos, 0], [0, 0, 1]], dtype=np.float64)
+
+
+# 縮尺をかけてからオフセットを足す3x3の行列を作る関数
+def scale_offset_matrix(size, field=(20, 40), origin=(10, -20)):
+    transform = output_transform(size, field=field, origin=origin)
+    scaling = np.diag([*transform['scale'], 1.0])
+    translation = np.array([[1, 0, transform['offset'][0]], [0, 1, transform['offset'][1]], [0, 0, 1]],
+                           dtype=np.float64)
+    return translation @ scaling
+
+
+# (N, 4)の座標配列の始点・終点にアフィン行列を一括で適用する関数(丸めは最後に1回だけ行う)
+def transform_segments(segments, matrix, decimals=2):
+    points = np.asarray(segments, dtype=np.float64).reshape(-1, 2)
+    transformed = points @ matrix[:2, :2].T + matrix[:2, 2]
+    return np.round(transformed, decimals).reshape(-1, 4)
+
+
+# 座標をcsvファイルに保存する関数(1行ずつではなくまとめて書き出す。辞書と(N, 4)の配列のどちらも受け付ける)
+def write_segments_csv(csv_file_path, segments, start_index=0):
+    with open(csv_file_path, mode='w', newline='', buffering=1 << 20) as file:
+        writer = csv.writer(file)
+        writer.writerow(['Index', 'X1', 'Y1', 'X2', 'Y2'])
+        write_segment_rows(writer, segments, start_index)
+
+
+# 座標の行をcsv.writerにまとめて書き込む関数
+def write_segment_rows(writer, segments, start_index=0):
+    if isinstance(segments, dict):
+        writer.writerows([index, *segment] for index, segment in segments.items())
+    else:
+        rows = np.asarray(segments).tolist()
+        writer.writerows([index, *segment] for index, segment in enumerate(rows, start_index))
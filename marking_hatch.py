@@ -0,0 +1,49 @@
+import numpy as np
+
+from marking_engine import contour_segments, rotation_matrix
+from marking_toolpath import project_segments
+
+
+# 輪郭(穴を含む)の内側を、出力座標で一定の間隔・角度の平行線で塗りつぶす線分を求める関数
+# (matrixは画像の座標から出力座標へのアフィン行列、pitch・angleは出力座標の単位・度で指定し、画像の座標の(N, 4)の配列を返す)
+def hatch_segments(contours, matrix, pitch, angle=0.0, serpentine=False):
+    edges = contour_segments(contours, closed=True)
+    if not len(edges) or pitch <= 0:
+        return np.empty((0, 4), dtype=np.float64)
+
+    # 走査線が水平になる座標系に全ての辺をまとめて移す
+    to_hatch = rotation_matrix(-angle) @ matrix
+    x1, y1, x2, y2 = project_segments(edges, to_hatch).T
+
+    # 各辺が交わる走査線(y = k * pitch)の番号を求める(下端を含み上端を含まないので、頂点で二重に数えない)
+    low, high = np.minimum(y1, y2), np.maximum(y1, y2)
+    first = np.ceil(low / pitch).astype(np.int64)
+    counts = np.maximum(np.ceil(high / pitch).astype(np.int64) - first, 0)
+    if not counts.sum():
+        return np.empty((0, 4), dtype=np.float64)
+    edge_index = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    rows = first[edge_index] + offsets
+
+    # 走査線と辺の交点のX座標(水平な辺は走査線と交わらないため0で割ることはない)
+    y = rows * pitch
+    t = (y - y1[edge_index]) / (y2[edge_index] - y1[edge_index])
+    x = x1[edge_index] + t * (x2[edge_index] - x1[edge_index])
+
+    # 閉じた輪郭は各走査線と偶数回交わるため、走査線ごとに左から2つずつ組にすると内側(穴の外)の区間になる
+    order = np.lexsort((x, rows))
+    rows, x = rows[order], x[order]
+    rows, starts, ends = rows[0::2], x[0::2], x[1::2]
+    keep = ends > starts
+    rows, starts, ends = rows[keep], starts[keep], ends[keep]
+
+    if serpentine and len(rows):
+        # 走査線ごとに左右交互の向きにする(戻りの走査線は右の区間から順に右から左へ)
+        backward = np.unique(rows, return_inverse=True)[1].reshape(-1) % 2 == 1
+        order = np.lexsort((np.where(backward, -starts, starts), rows))
+        rows, starts, ends, backward = rows[order], starts[order], ends[order], backward[order]
+        starts, ends = np.where(backward, ends, starts), np.where(backward, starts, ends)
+
+    y = rows * pitch
+    hatch = np.column_stack([starts, y, ends, y])
+    return project_segments(hatch, np.linalg.inv(to_hatch))
@@ -0,0 +1,31 @@
+import math
+
+from PIL import Image
+
+from marking_preview import PREVIEW_WIDTH
+
+
+# プレビュー用に縮小デコードした画像を読み込む関数
+def load_preview(file_path, width=PREVIEW_WIDTH):
+    with Image.open(file_path) as image:
+        height = max(1, int(image.size[1] * width / image.size[0]))
+
+        # JPEGは1/2〜1/8の縮小デコード、それ以外はreduceで粗く縮小してから仕上げる
+        image.draft('RGB', (width, height))
+        return image.resize((width, height), Image.LANCZOS, reducing_gap=2.0)
+
+
+# 処理に必要な解像度で画像を開く関数(reducedならJPEGは縮小・グレースケールでデコードする)
+def open_for_processing(file_path, factor, reduced=True):
+    image = Image.open(file_path)
+    image.info['decode_scale'] = 1
+    if not reduced or image.format != 'JPEG' or not float(factor).is_integer():
+        return image
+
+    # factorを割り切る2のべき乗で縮小すれば、粗くした後の格子の大きさは変わらない
+    scale = min(8, int(factor) & -int(factor))
+    if scale > 1:
+        width, height = image.size
+        image.draft('L', (math.ceil(width / scale), math.ceil(height / scale)))
+        image.info['decode_scale'] = round(width / image.size[0])
+    return image
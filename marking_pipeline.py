@@ -0,0 +1,436 @@
+import copy
+
+import numpy as np
+from PIL import Image
+
+from marking_engine import (
+    crop_box, crop_grayscale, binarize_mask, extract_runs, expand_runs, runs_to_dict, output_transform,
+    rotation_matrix, scale_offset_matrix, transform_segments, write_segments_csv, contour_segments, coarsen_area,
+    coarsen_majority, coarsen_nearest, expand_blocks, coarse_points_to_full, merge_collinear_segments,
+    merge_runs_into_blocks, OUTPUT_FIELD
+)
+from marking_hatch import hatch_segments
+from marking_preview import PREVIEW_WIDTH
+from marking_profile import StageProfiler
+from marking_tiles import tile_transitions
+from marking_toolpath import blocks_to_rows, schedule_segments, travel_distance
+from marking_writers import write_segments
+
+
+class ImageProcessor:
+    # 画像から塗りと輪郭の座標を作る処理をまとめたクラス(tkinterに依存せず、OpenCVは輪郭の処理で初めて読み込む)
+    # process_imageの工程(進捗表示に使用)
+    stages = ('トリミング', '2値化', '粗くする', '塗りつぶし', '輪郭', '並べ替え')
+    # process_imageが最後にまとめて反映する処理結果の属性
+    results = ('decode_scale', 'cropped_image', 'full_size', 'binary_mask', 'applied_threshold', 'marking_mask',
+               'coarse_grid', 'output_size', 'transitions', 'filtered_contours', 'contour_segments',
+               'optimized_segments', 'scheduled_segments', 'travel', 'segment_counts', 'result_key', 'cached_preview',
+               'processed_key', 'profiler')
+
+    def __init__(self):
+        # デフォルトパラメータの初期化
+        self.threshold = 30  # Noneの場合は大津の方法で自動決定する
+        self.factor = 10
+        self.cutoff_area = 100
+
+        # 画像の向きと座標の単位(左右反転する, 粗い画像の画素単位の座標のまま出力する)
+        self.flip = False
+        self.coarse_coordinates = False
+
+        # 拡大せず粗い画像のまま座標を抽出し、元サイズの座標に換算する
+        self.coarse_native = True
+
+        # 粗くする方法('nearest'は各ブロックの1画素を採用, 'area'はグレースケールのブロック平均を2値化,
+        # 'majority'は2値化画像のブロックごとの多数決)
+        self.coarsen_mode = 'nearest'
+
+        # 塗る側の色('black'または'white')と、塗りの抽出を並列に行うスレッド数
+        self.polarity = 'black'
+        self.run_workers = 1
+
+        # tile_min_pixels以上の画像は、2値化・粗くする・塗りの抽出を行の帯に分けてtile_workers個のプロセスで行う
+        # (1なら分けない。元のサイズに戻して抽出する場合(coarse_nativeがFalse)は使わない)
+        self.tile_workers = 1
+        self.tile_min_pixels = 8_000_000
+
+        # 輪郭も出力する、輪郭の終点から始点に戻る線分も出力する
+        self.include_contours = True
+        self.close_contours = False
+
+        # 線分数を減らす設定(輪郭の簡略化の許容誤差[出力座標の単位, 0で無効], 同じ向きに続く線分の結合,
+        # 塗りの出力方法('rows'は1行ずつ、'blocks'は連続する行の同じ範囲を矩形にまとめて矩形ごとに続けて出力する、
+        # 'hatch'は画素の行ではなく輪郭(穴を含む)の内側を出力座標で一定の間隔・角度の平行線で塗る))
+        self.simplify_tolerance = 0.0
+        self.merge_collinear = True
+        self.fill_mode = 'rows'
+
+        # hatchの線の間隔[出力座標の単位]と角度[度](出力座標のX軸から反時計回り)
+        self.hatch_pitch = 0.1
+        self.hatch_angle = 0.0
+
+        # 出力順の設定(塗りは'raster'(行ごとに左から)か'serpentine'(行ごとに左右交互),
+        # 輪郭は'none'(検出順), 'nearest'(最も近い輪郭から), '2opt'(nearestをさらに改善))
+        self.fill_order = 'raster'
+        self.contour_order = 'none'
+
+        # 出力座標系(回転角度[度], 回転後のX・Yを合わせる長さ(短辺, 長辺), 原点のオフセット)と出力形式
+        self.output_field = dict(OUTPUT_FIELD)
+        self.output_formats = ('csv',)
+
+        # 工程ごとの処理結果のキャッシュ(Noneなら毎回計算する)と、キャッシュのキーにする画像のダイジェスト
+        self.stage_cache = None
+        self.image_digest = None
+        self.processed_key = None  # 反映済みの結果を処理した画像とパラメータ(is_currentで使う)
+
+        # 最終的な座標とプレビュー画像をファイルに保存するキャッシュ(marking_cache.DiskCache, Noneなら使わない)
+        self.result_cache = None
+        self.result_key = None
+        self.cached_preview = None
+
+        # 直近の処理における工程ごとの処理時間・ピークメモリ・出力の大きさ
+        self.profiler = StageProfiler()
+        self.applied_threshold = None  # 直近の処理で実際に使用したしきい値
+        self.decode_scale = 1  # 縮小デコードされた画像の縮小率
+
+    # パラメータの更新
+    def set_parameters(self, threshold, factor, cutoff_area):
+        self.threshold = threshold
+        self.factor = factor
+        self.cutoff_area = cutoff_area
+
+    # 画像処理を実行し、出力順に並べた(N, 4)の線分の配列を返す関数
+    # (パラメータを固定したコピーで全工程を行い、最後の工程が終わってから結果をまとめて反映する)
+    def process_image(self, image, checkpoint=None):
+        job = self.snapshot()
+        job.run_stages(image, checkpoint or (lambda step, total, message="": None))
+        for name in self.results:
+            setattr(self, name, getattr(job, name))
+        return self.scheduled_segments
+
+    # パラメータを固定した作業用のコピーを返す関数(処理中に画面側でパラメータが変更されても、
+    # キャッシュのキーと計算に同じ値を使う。工程のキャッシュは共有する)
+    def snapshot(self):
+        job = copy.copy(self)
+        job.output_field = dict(self.output_field)
+        job.profiler = StageProfiler(memory=self.profiler.memory)
+        return job
+
+    # 反映済みの結果が現在の画像・パラメータで処理したものかを返す関数(中止・処理中なら古い結果のまま)
+    def is_current(self):
+        return self.processed_key == (self.image_digest,) + self.stage_keys()[-1]
+
+    # 各工程のキャッシュキーを求める関数(キーにはその工程が依存するパラメータだけを含める)
+    def stage_keys(self):
+        binarize_key = (self.flip, self.threshold)
+        coarse_key = binarize_key + (self.factor, self.coarse_native, self.coarsen_mode, self.polarity,
+                                     self.coarse_coordinates)
+        # hatchでは穴の輪郭も検出するため、輪郭の工程はhatchかどうかでキーを分ける
+        contour_key = coarse_key + (self.include_contours, self.cutoff_area, self.fill_mode == 'hatch')
+        field_key = tuple(sorted(self.output_field.items()))
+        hatch_key = coarse_key + (self.cutoff_area, self.hatch_pitch, self.hatch_angle, self.fill_order, field_key)
+        optimize_key = contour_key + (self.close_contours, self.simplify_tolerance, self.merge_collinear,
+                                      self.fill_mode, field_key)
+        if self.fill_mode == 'hatch':
+            optimize_key += hatch_key
+        order_key = optimize_key + (self.fill_order, self.contour_order)
+        return binarize_key, coarse_key, contour_key, hatch_key, optimize_key, order_key
+
+    # 全工程を実行する関数(snapshotで作ったコピーで実行する)
+    def run_stages(self, image, checkpoint):
+        total = len(self.stages)
+        self.decode_scale = image.info.get('decode_scale', 1)
+        binarize_key, coarse_key, contour_key, hatch_key, optimize_key, order_key = self.stage_keys()
+        self.processed_key = (self.image_digest,) + order_key
+
+        # 同じ画像・同じパラメータの結果が保存されていれば、読み込むだけで終える
+        self.cached_preview = None
+        self.result_key = None
+        if self.result_cache is not None and self.image_digest is not None:
+            self.result_key = (self.image_digest, self.decode_scale) + order_key
+            if self.restore_result():
+                checkpoint(total, total, "キャッシュ")
+                return
+
+        checkpoint(0, total, self.stages[0])
+        self.cropped_image = self.cached('crop_image', (), lambda: self.crop_image(image))
+        if self.flip:
+            self.cropped_image = self.cached('flip_image_horizontally', (),
+                                             lambda: self.flip_image_horizontally(self.cropped_image))
+        self.full_size = self.cropped_image.size
+
+        # 2値化以降は白のブール配列のまま受け渡し、PIL・OpenCV用の変換を挟まない
+        checkpoint(1, total, self.stages[1])
+        if self.use_tiles():
+            self.binary_mask = None
+            self.marking_mask, self.coarse_grid, self.transitions, self.applied_threshold = self.cached(
+                'tile_transitions', coarse_key, self.tile_transitions
+            )
+        else:
+            self.binary_mask, self.applied_threshold = self.cached(
+                'binarize_image', binarize_key, lambda: self.binarize_image(self.cropped_image)
+            )
+            checkpoint(2, total, self.stages[2])
+            self.marking_mask, self.coarse_grid = self.cached(
+                'make_pixels_coarser', coarse_key, lambda: self.make_pixels_coarser(self.binary_mask)
+            )
+            checkpoint(3, total, self.stages[3])
+            if self.fill_mode != 'hatch':
+                self.transitions = self.cached('extract_transitions', coarse_key,
+                                               lambda: self.extract_transitions(self.marking_mask))
+        self.output_size = (self.marking_mask.shape[1], self.marking_mask.shape[0]) if self.coarse_coordinates \
+            else self.full_size
+        checkpoint(4, total, self.stages[4])
+        self.filtered_contours = self.cached('extract_contours', contour_key, self.extract_contours)
+        self.contour_segments = self.cached('flatten_contours', contour_key + (self.close_contours,),
+                                            self.flatten_contours)
+        if self.fill_mode == 'hatch':
+            # 塗りは画素の行ではなく輪郭から作るため、粗くした画像の解像度によらず線の間隔が一定になる
+            self.transitions = self.cached('hatch_fill', hatch_key, self.hatch_fill)
+        checkpoint(5, total, self.stages[5])
+        self.optimized_segments = self.cached('optimize_segments', optimize_key, self.optimize_segments)
+        self.scheduled_segments, self.travel = self.cached('schedule_segments', order_key, self.schedule_segments)
+        self.segment_counts = (len(self.transitions), len(self.contour_segments))
+        if self.result_key is not None:
+            self.profiler.measure('store_result', self.store_result)
+
+    # 保存された結果を読み込み、出力とプレビューに必要な属性を復元する関数(なければFalseを返す)
+    def restore_result(self):
+        arrays = self.profiler.measure('load_result', self.result_cache.load_arrays, self.result_key)
+        if arrays is None:
+            return False
+        self.scheduled_segments = arrays['segments']
+        self.travel = tuple(arrays['travel'].tolist())
+        self.full_size = tuple(arrays['full_size'].tolist())
+        self.output_size = tuple(arrays['output_size'].tolist())
+        self.applied_threshold = int(arrays['applied_threshold'])
+        self.segment_counts = tuple(arrays['segment_counts'].tolist())
+        self.cached_preview = Image.fromarray(arrays['preview'])
+        # 途中の工程の結果は保存しないため、古い画像の結果が残らないよう消しておく
+        self.cropped_image = self.binary_mask = self.marking_mask = self.coarse_grid = None
+        self.transitions = self.filtered_contours = self.contour_segments = self.optimized_segments = None
+        return True
+
+    # 出力順に並べた座標・出力座標系の計算に必要な値・プレビュー画像を保存する関数
+    def store_result(self):
+        self.cached_preview = self.render_preview()
+        self.result_cache.save_arrays(self.result_key, {
+            'segments': self.scheduled_segments,
+            'travel': np.array(self.travel),
+            'full_size': np.array(self.full_size),
+            'output_size': np.array(self.output_size),
+            'applied_threshold': np.array(self.applied_threshold),
+            'segment_counts': np.array(self.segment_counts),
+            'preview': np.asarray(self.cached_preview),
+        })
+
+    # 工程の結果をキャッシュから取得し、なければ計算して処理時間を記録する関数
+    def cached(self, stage, params, compute):
+        if self.stage_cache is None or self.image_digest is None:
+            return self.profiler.measure(stage, compute)
+        recorded = len(self.profiler.records)
+        result = self.stage_cache.get_or_compute(
+            (self.image_digest, stage) + params, lambda: self.profiler.measure(stage, compute)
+        )
+        if len(self.profiler.records) == recorded:
+            self.profiler.skip(stage)
+        return result
+
+    # 直近の処理における工程ごとの処理時間[秒]
+    @property
+    def timings(self):
+        return self.profiler.timings
+
+    # 画像を2:1にトリミングする関数
+    def crop_image(self, image):
+        # グレースケールに変換してから切り出し、カラーの切り出し画像を作らない
+        return crop_grayscale(image, crop_box(image.size))
+
+    # 画像を左右反転させる関数
+    def flip_image_horizontally(self, image):
+        return image.transpose(Image.FLIP_LEFT_RIGHT)
+
+    # 画像を2値化処理し、白のブール配列としきい値を返す関数(thresholdがNoneなら大津の方法で決める)
+    def binarize_image(self, image):
+        return binarize_mask(image, self.threshold)
+
+    # 画像のピクセルを粗くし、粗い配列とブロックの境界(元のサイズのままならNone)を返す関数
+    def make_pixels_coarser(self, mask):
+        # 縮小デコード済みの画像では残りの倍率だけ粗くする
+        if self.coarsen_mode == 'area':
+            coarser_mask, edges = coarsen_area(self.cropped_image, self.block_factor(), self.applied_threshold)
+        elif self.coarsen_mode == 'majority':
+            coarser_mask, edges = coarsen_majority(mask, self.block_factor())
+        else:
+            coarser_mask, edges = coarsen_nearest(mask, max(1, self.factor // self.decode_scale))
+
+        if self.coarse_native or self.coarse_coordinates:
+            return coarser_mask, edges
+        return expand_blocks(coarser_mask, edges), None
+
+    # ブロックごとに粗くする際の倍率を求める関数
+    def block_factor(self):
+        if self.decode_scale == 1:
+            return self.factor
+        return max(1, self.factor / self.decode_scale)
+
+    # 2値化・粗くする・塗りの抽出を行の帯に分けて複数のプロセスで行うかを判定する関数
+    def use_tiles(self):
+        width, height = self.full_size
+        return (self.tile_workers > 1 and width * height >= self.tile_min_pixels
+                and (self.coarse_native or self.coarse_coordinates))
+
+    # 2値化・粗くする・塗りの抽出を行の帯ごとに複数のプロセスで行う関数
+    # (粗い配列, ブロックの境界, 塗りの座標, しきい値を返す)
+    def tile_transitions(self):
+        if self.coarsen_mode in ('area', 'majority'):
+            factor = self.block_factor()
+        else:
+            factor = max(1, self.factor // self.decode_scale)
+        return tile_transitions(self.cropped_image, self.threshold, factor, self.coarsen_mode, self.polarity,
+                                not self.coarse_coordinates, self.tile_workers)
+
+    # 塗りつぶしの座標を(N, 4)の配列で抽出する関数
+    def extract_transitions(self, mask):
+        transitions = extract_runs(mask, self.polarity, self.run_workers)
+        if self.coarse_grid is not None and not self.coarse_coordinates:
+            coarse_size = (mask.shape[1], mask.shape[0])
+            transitions = expand_runs(transitions, coarse_size, self.full_size, self.coarse_grid)
+        return transitions
+
+    # cutoff以上の面積の輪郭を抽出する関数
+    def extract_contours(self):
+        if not self.include_contours:
+            return []
+        return self.large_contours()
+
+    # cutoff以上の面積の輪郭を返す関数(hatchでは穴の輪郭も含む)
+    def large_contours(self):
+        # 輪郭の検出はcutoffに依存しないため、粗い画像ごとにキャッシュする
+        contours, areas = self.cached('find_contours', (self.flip, self.threshold, self.factor, self.coarse_native,
+                                                        self.coarsen_mode, self.polarity, self.coarse_coordinates,
+                                                        self.fill_mode == 'hatch'),
+                                      self.find_contours)
+        return [cnt for cnt, area in zip(contours, areas) if self.cutoff_area <= area]
+
+    # 粗い画像から輪郭を検出し、出力する座標と元画像上の面積を求める関数
+    def find_contours(self):
+        from cv2 import findContours, RETR_CCOMP, RETR_EXTERNAL, CHAIN_APPROX_SIMPLE, contourArea
+
+        # 塗る側の画素を1にして輪郭を検出する(hatchでは穴を塗らないよう、穴の輪郭も検出する)
+        mark = ~self.marking_mask if self.polarity == 'black' else self.marking_mask
+        mode = RETR_CCOMP if self.fill_mode == 'hatch' else RETR_EXTERNAL
+        contours, _ = findContours(mark.astype(np.uint8), mode, CHAIN_APPROX_SIMPLE)
+        if self.coarse_grid is None:
+            return contours, [contourArea(cnt) for cnt in contours]
+
+        # cutoffは元画像の画素数で判定する
+        full_contours = [coarse_points_to_full(cnt, self.coarse_grid) for cnt in contours]
+        areas = [contourArea(cnt) for cnt in full_contours]
+        return (contours if self.coarse_coordinates else full_contours), areas
+
+    # 輪郭抽出した座標を線分の配列に変換する関数
+    def flatten_contours(self):
+        return contour_segments(self.filtered_contours, self.close_contours)
+
+    # 輪郭の内側を出力座標で一定の間隔・角度の平行線で塗る線分を求める関数
+    def hatch_fill(self):
+        return hatch_segments(self.large_contours(), self.output_matrix(), self.hatch_pitch, self.hatch_angle,
+                              self.fill_order == 'serpentine')
+
+    # 塗と輪郭の座標の線分数を減らす関数
+    def optimize_segments(self):
+        transitions = self.transitions
+        if self.fill_mode == 'blocks':
+            transitions = merge_runs_into_blocks(transitions)
+
+        contour_lines = self.contour_segments
+        if self.simplify_tolerance > 0 and self.filtered_contours:
+            from cv2 import approxPolyDP
+
+            # 許容誤差を出力座標の単位から画素の単位に換算してDouglas-Peuckerで簡略化する
+            scale = max(output_transform(self.output_size, **self.output_field)['scale'])
+            epsilon = self.simplify_tolerance / scale
+            simplified = [approxPolyDP(cnt, epsilon, True) for cnt in self.filtered_contours]
+            contour_lines = contour_segments(simplified, self.close_contours)
+        if self.merge_collinear:
+            contour_lines = merge_collinear_segments(contour_lines)
+
+        return transitions, contour_lines
+
+    # 塗と輪郭の座標を(N, 4)の配列に結合し、マーキングヘッドの移動が短くなるよう並べる関数
+    def schedule_segments(self):
+        transitions, contour_lines = self.optimized_segments
+        matrix = self.output_matrix()
+        # hatchの線はhatch_fillで走査線の順に並べてある
+        fill_order = 'raster' if self.fill_mode == 'hatch' else self.fill_order
+        blocks = self.fill_mode == 'blocks'
+        # 矩形はcsvなどの線分の形式で表せないため、並べた後に1行ごとの線分に展開する
+        scheduled = schedule_segments(transitions, contour_lines, fill_order, self.contour_order, matrix, blocks)
+        if blocks:
+            transitions = blocks_to_rows(transitions)
+
+        # 出力座標での移動距離(並べ替え前, 並べ替え後)
+        travel = (travel_distance(np.concatenate([transitions, contour_lines]), matrix),
+                  travel_distance(scheduled, matrix))
+        return scheduled, travel
+
+    # 塗りと輪郭の座標を出力順に1つの辞書にまとめる関数
+    def merge_dictionaries(self):
+        return runs_to_dict(self.scheduled_segments)
+
+    # 出力座標系の回転の行列を返す関数
+    def rotate_90(self):
+        return rotation_matrix(self.output_field['angle'])
+
+    # 出力座標系の縮尺・オフセットの行列を返す関数(切り出した画像のサイズを基準に縮尺を決める)
+    def scale_and_offset(self):
+        return scale_offset_matrix(self.output_size, self.output_field['field'], self.output_field['origin'])
+
+    # 回転・縮尺・オフセットをまとめた行列を返す関数
+    def output_matrix(self):
+        return self.scale_and_offset() @ self.rotate_90()
+
+    # 座標を回転・縮小・オフセットする関数
+    def transform(self, segments):
+        return transform_segments(segments, self.output_matrix())
+
+    # 出力座標に変換した座標を形式ごとのファイルに書き出し、線分数を返す関数(output_pathsは{形式: パス})
+    def export(self, output_paths):
+        segments = self.profiler.measure('transform', self.transform, self.scheduled_segments)
+        self.profiler.measure('save_segments', self.save_segments, segments, output_paths)
+        return len(segments)
+
+    # 座標ファイルを保存する関数
+    def save_segments(self, segments, output_paths):
+        # 書き出す座標は変換済みのため、適用した変換と一緒に変換済みであることを記録する
+        metadata = {**output_transform(self.output_size, **self.output_field), 'transformed': True}
+        for output_format, file_path in output_paths.items():
+            write_segments(file_path, segments, metadata, output_format)
+
+    # 出力座標に変換した座標をcsvファイルに保存する関数
+    def save_dict_to_csv(self, csv_file_path):
+        write_segments_csv(csv_file_path, self.transform(self.scheduled_segments))
+
+    # プレビュー画像を返す関数(キャッシュから読み込んだ・保存した画像があればそれを使う)
+    def preview(self, width=PREVIEW_WIDTH):
+        if self.cached_preview is None:
+            return self.render_preview(width)
+        if self.cached_preview.width == width:
+            return self.cached_preview
+        height = max(1, int(self.cached_preview.height * width / self.cached_preview.width))
+        return self.cached_preview.resize((width, height), Image.NEAREST)
+
+    # 粗くした画像に輪郭を描いたプレビュー画像を作る関数(プレビューの大きさで描画する)
+    def render_preview(self, width=PREVIEW_WIDTH):
+        mask_width, mask_height = self.output_size
+        preview_size = (width, max(1, int(mask_height * width / mask_width)))
+        preview = Image.fromarray(self.marking_mask).resize(preview_size, Image.NEAREST).convert('RGB')
+        if not self.filtered_contours:
+            return preview
+
+        from cv2 import drawContours
+
+        canvas = np.array(preview)
+        scale = width / mask_width
+        drawContours(canvas, [(cnt * scale).astype(np.int32) for cnt in self.filtered_contours], -1, (255, 0, 0), 1)
+        return Image.fromarray(canvas)
@@ -0,0 +1,44 @@
+import numpy as np
+from PIL import Image
+
+from marking_engine import otsu_threshold
+
+PREVIEW_WIDTH = 320
+
+
+# ライブプレビュー用に縮小したグレースケール画像を作る関数
+def make_proxy(image, long_side=640):
+    width, height = image.size
+    scale = min(1.0, long_side / max(width, height))
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return image.resize(size, Image.BOX).convert('L')
+
+
+# 縮小画像で2値化・粗くする・輪郭描画を行い、プレビュー画像を作る関数
+def render_live_preview(proxy, full_size, threshold, factor, cutoff_area=None):
+    if threshold is None:
+        threshold = otsu_threshold(proxy.histogram())
+    white = np.asarray(proxy) > threshold
+    binary_image = Image.fromarray(white)
+
+    # 粗い画像が縮小画像より小さい場合だけ、本処理と同じ格子に粗くする
+    coarse_size = (max(1, full_size[0] // factor), max(1, full_size[1] // factor))
+    if coarse_size[0] < proxy.size[0]:
+        binary_image = binary_image.resize(coarse_size, Image.NEAREST)
+
+    preview_size = (PREVIEW_WIDTH, max(1, int(full_size[1] * PREVIEW_WIDTH / full_size[0])))
+    preview = binary_image.resize(preview_size, Image.NEAREST).convert('RGB')
+    if cutoff_area is None:
+        return preview
+
+    from cv2 import findContours, RETR_EXTERNAL, CHAIN_APPROX_SIMPLE, contourArea, drawContours
+
+    # 輪郭は縮小画像で検出し、面積のcutoffも縮小率に合わせる
+    contours, _ = findContours(np.where(white, 0, 255).astype(np.uint8), RETR_EXTERNAL, CHAIN_APPROX_SIMPLE)
+    area_scale = (proxy.size[0] / full_size[0]) ** 2
+    preview_scale = preview_size[0] / proxy.size[0]
+    drawn_contours = [(cnt * preview_scale).astype(np.int32) for cnt in contours
+                      if cutoff_area * area_scale <= contourArea(cnt)]
+    canvas = np.array(preview)
+    drawContours(canvas, drawn_contours, -1, (255, 0, 0), 1)
+    return Image.fromarray(canvas)
@@ -0,0 +1,126 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import time
+import tracemalloc
+
+import numpy as np
+
+
+# 工程の出力の大きさを表す値を求める関数(配列は形状、画像はサイズ、それ以外は要素数)
+def output_size(result):
+    if isinstance(result, np.ndarray):
+        return list(result.shape)
+    if hasattr(result, 'size') and isinstance(result.size, tuple):
+        return list(result.size)
+    if isinstance(result, tuple) and result:
+        return output_size(result[0])
+    if hasattr(result, '__len__'):
+        return len(result)
+    return None
+
+
+class StageProfiler:
+    # 工程ごとの処理時間・ピークメモリ・出力の大きさを記録するクラス
+    def __init__(self, memory=False):
+        self.memory = memory  # tracemallocでピークメモリも測る(測定中は処理が遅くなる)
+        self.records = []
+        self.peaks = []  # 測定中の工程ごとの、内側の工程で測ったピークメモリの最大値(外側から順)
+
+    def reset(self):
+        self.records = []
+        self.peaks = []
+
+    # 工程を実行して記録する関数
+    # (工程の中で別の工程を測った場合、内側の記録にはdepthを付け、外側のピークメモリは内側の分も含める)
+    def measure(self, stage, function, *args, **kwargs):
+        depth = len(self.peaks)
+        memory = self.memory
+        if memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            if self.peaks:
+                # reset_peakで外側の工程のここまでのピークが消えるため、先に控えておく
+                self.peaks[-1] = max(self.peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self.peaks.append(0)
+        start = time.perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            inner_peak = self.peaks.pop()
+        record = {'stage': stage, 'seconds': time.perf_counter() - start, 'output': output_size(result)}
+        if depth:
+            record['depth'] = depth
+        if memory:
+            record['peak_bytes'] = max(inner_peak, tracemalloc.get_traced_memory()[1])
+            if self.peaks:
+                self.peaks[-1] = max(self.peaks[-1], record['peak_bytes'])
+        self.records.append(record)
+        return result
+
+    # キャッシュから取得した工程を記録する関数
+    def skip(self, stage):
+        self.records.append({'stage': stage, 'seconds': 0.0, 'output': None, 'cached': True})
+
+    # 工程ごとの処理時間[秒]の辞書
+    @property
+    def timings(self):
+        timings = {}
+        for record in self.records:
+            timings[record['stage']] = timings.get(record['stage'], 0.0) + record['seconds']
+        return timings
+
+    # ステータスバーに表示する要約を作る関数
+    def summary(self):
+        total = total_seconds(self.records)
+        slowest = sorted((r for r in self.records if not r.get('cached')), key=lambda r: -r['seconds'])[:3]
+        parts = [f"{r['stage']} {r['seconds'] * 1000:.0f}ms" for r in slowest]
+        peaks = [record['peak_bytes'] for record in self.records if 'peak_bytes' in record]
+        if peaks:
+            parts.append(f"ピーク {max(peaks) / 2 ** 20:.0f}MiB")
+        cached = sum(1 for record in self.records if record.get('cached'))
+        return f"合計 {total * 1000:.0f}ms / " + ", ".join(parts) + (f" / キャッシュ {cached}工程" if cached else "")
+
+    # 1回分の記録をJSON Linesのファイルに追記する関数
+    def write_jsonl(self, file_path, **fields):
+        append_jsonl(file_path, {**fields, 'stages': self.records})
+
+
+# 記録の合計処理時間[秒]を求める関数(他の工程の中で測った工程は外側の工程の時間に含まれるため数えない)
+def total_seconds(records):
+    return sum(record['seconds'] for record in records if not record.get('depth'))
+
+
+# 1行分の記録を時刻付きでJSON Linesのファイルに追記する関数
+def append_jsonl(file_path, entry):
+    with open(file_path, 'a', encoding='utf-8') as file:
+        file.write(json.dumps({'time': time.time(), **entry}, ensure_ascii=False) + "\n")
+
+
+# cProfileとtracemallocで関数を実行し、レポートをファイルに書き出す関数
+def profile_call(report_path, function, *args, top=30):
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    try:
+        result = profiler.runcall(function, *args)
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(top)
+    os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+    with open(report_path, 'w', encoding='utf-8') as file:
+        file.write(f"# ピークメモリ: {peak / 2 ** 20:.1f} MiB\n\n# cProfile (累積時間順)\n")
+        file.write(stream.getvalue())
+        file.write("\n# tracemalloc (確保量の多い行)\n")
+        for statistic in snapshot.statistics('lineno')[:top]:
+            file.write(f"{statistic}\n")
+    return result
@@ -0,0 +1,335 @@
+import argparse
+import hashlib
+import io
+import json
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import get_context
+from urllib.parse import urlsplit, parse_qs
+
+from PIL import Image
+
+from marking_batch import DEFAULT_OPTIONS, make_processor, parse_threshold
+from marking_cache import StageCache, DiskCache, file_digest
+from marking_engine import check_factor
+from marking_loader import open_for_processing
+from marking_profile import total_seconds
+from marking_watcher import Metrics
+
+# 応答できる出力形式(1つのファイルで完結するもの)とContent-Type
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'bin': 'application/octet-stream',
+    'npz': 'application/octet-stream',
+}
+
+# リクエストのクエリで指定できる設定と変換方法
+QUERY_OPTIONS = {
+    'threshold': parse_threshold,
+    'factor': float,
+    'cutoff': int,
+    'reduced_decode': lambda value: value.lower() in ('1', 'true', 'yes'),
+    'contours': lambda value: value.lower() in ('1', 'true', 'yes'),
+    'polarity': str,
+    'coarsen': str,
+    'fill_mode': str,
+    'fill_order': str,
+    'contour_order': str,
+    'hatch_pitch': float,
+    'hatch_angle': float,
+    'simplify': float,
+    'merge_collinear': lambda value: value.lower() in ('1', 'true', 'yes'),
+}
+# クエリの名前とDEFAULT_OPTIONSのキーが異なるもの
+QUERY_KEYS = {'cutoff': 'cutoff_area', 'reduced_decode': 'reduced_decoding', 'coarsen': 'coarsen_mode',
+              'simplify': 'simplify_tolerance'}
+CHOICES = {
+    'polarity': ('black', 'white'),
+    'coarsen_mode': ('nearest', 'area', 'majority'),
+    'fill_mode': ('rows', 'blocks', 'hatch'),
+    'fill_order': ('raster', 'serpentine'),
+    'contour_order': ('none', 'nearest', '2opt'),
+}
+
+# ワーカープロセスごとに使い回すキャッシュ(init_workerで作る)
+worker_caches = {}
+
+
+# ワーカープロセスの起動時にOpenCVなどを読み込み、小さな画像を1回処理しておく関数
+def init_worker(cache_dir=None, stage_cache_bytes=256 * 1024 * 1024):
+    worker_caches['stage'] = StageCache(stage_cache_bytes)
+    worker_caches['disk'] = DiskCache(cache_dir) if cache_dir else None
+    # 輪郭の検出・描画まで通るよう、黒い矩形を描いた画像を使う
+    image = Image.new('RGB', (64, 32), 'white')
+    image.paste((0, 0, 0), (16, 8, 48, 24))
+    processor = make_processor(DEFAULT_OPTIONS)
+    processor.process_image(image)
+    processor.render_preview()
+
+
+# ワーカープロセスが起動済みかを確認するための関数
+def worker_ready():
+    return os.getpid()
+
+
+# クエリ文字列を処理の設定と出力形式に変換する関数(不正な値はValueError)
+def parse_query(query):
+    options = dict(DEFAULT_OPTIONS)
+    output_format = 'csv'
+    for name, values in parse_qs(query).items():
+        value = values[-1]
+        if name == 'format':
+            output_format = value.lower()
+            continue
+        if name == 'path':
+            continue
+        if name not in QUERY_OPTIONS:
+            raise ValueError(f"未対応の設定です: {name}")
+        key = QUERY_KEYS.get(name, name)
+        try:
+            options[key] = QUERY_OPTIONS[name](value)
+        except ValueError:
+            raise ValueError(f"{name}の値が不正です: {value}") from None
+        if key in CHOICES and options[key] not in CHOICES[key]:
+            raise ValueError(f"{name}は{', '.join(CHOICES[key])}のいずれかを指定してください。")
+    if output_format not in CONTENT_TYPES:
+        raise ValueError(f"未対応の出力形式です: {output_format}")
+    if options['fill_mode'] == 'hatch' and options['hatch_pitch'] <= 0:
+        raise ValueError("hatch_pitchは0より大きい値を指定してください。")
+    if options['simplify_tolerance'] < 0:
+        raise ValueError("simplifyは0以上の値を指定してください。")
+    options['factor'] = check_factor(options['factor'], options['coarsen_mode'])
+    return options, output_format
+
+
+# 画像(バイト列またはサーバー上のパス)を処理し、(座標ファイルの内容, 線分数, 工程ごとの記録)を返す関数(ワーカープロセスで実行)
+def process_request(source, options, output_format):
+    processor = make_processor(options)
+    processor.stage_cache = worker_caches.get('stage')
+    processor.result_cache = worker_caches.get('disk')
+    if isinstance(source, str):
+        digest = processor.profiler.measure('file_digest', file_digest, source)
+        image = open_for_processing(source, options['factor'], options['reduced_decoding'])
+    else:
+        digest = hashlib.blake2b(source, digest_size=16).hexdigest()
+        image = open_for_processing(io.BytesIO(source), options['factor'], options['reduced_decoding'])
+
+    with image:
+        # 縮小デコードの有無で切り出した画像が変わるため、キャッシュのキーを分ける
+        processor.image_digest = f"{digest}/{image.info['decode_scale']}"
+        processor.process_image(image)
+
+    with tempfile.TemporaryDirectory() as directory:
+        output_path = os.path.join(directory, f'zahyou.{output_format}')
+        num_segments = processor.export({output_format: output_path})
+        with open(output_path, 'rb') as file:
+            data = file.read()
+    return data, num_segments, processor.profiler.records
+
+
+class MarkingServer(ThreadingHTTPServer):
+    # 起動済みのワーカープロセスで画像を処理するHTTPサーバー(同時に受け付ける数を超えたリクエストは503で断る)
+    daemon_threads = True
+
+    def __init__(self, address, workers=2, queue_size=8, cache_dir=None, max_bytes=256 * 1024 * 1024):
+        super().__init__(address, MarkingRequestHandler)
+        self.workers = workers
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.executor = self.make_executor()
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.rejected = 0
+        self.metrics = Metrics()
+
+    # 起動時にinit_workerを実行するワーカープロセスのプールを作る関数
+    def make_executor(self):
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context('spawn'),
+                                   initializer=init_worker, initargs=(self.cache_dir,))
+
+    # 全てのワーカープロセスを起動する関数(各ワーカーはinit_workerで読み込みと初回の処理を済ませてから処理を受け付ける)
+    def start_workers(self, executor):
+        return [executor.submit(worker_ready) for _ in range(self.workers)]
+
+    # ワーカープロセスで関数を実行する関数
+    # (ワーカーが異常終了するとプールは以後使えなくなるため、作り直してから渡し直す)
+    def submit(self, function, *args):
+        with self.lock:
+            executor = self.executor
+        try:
+            return executor.submit(function, *args)
+        except BrokenProcessPool:
+            self.restart_executor(executor)
+            with self.lock:
+                executor = self.executor
+            return executor.submit(function, *args)
+
+    # 使えなくなったプールを作り直す関数(同時に気付いた他のスレッドが作り直し済みなら何もしない)
+    def restart_executor(self, broken):
+        with self.lock:
+            if self.executor is not broken:
+                return
+            # 起動時と同じinit_workerで初期化し、次のリクエストを待たずに全てのワーカーを起動しておく
+            self.executor = self.make_executor()
+            self.start_workers(self.executor)
+        print("ワーカープロセスが異常終了したため、作り直します。", file=sys.stderr, flush=True)
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    # 全てのワーカープロセスを起動し、読み込みと初回の処理を済ませておく関数
+    def warm_up(self):
+        return sorted({future.result() for future in self.start_workers(self.executor)})
+
+    # 処理を受け付けられれば枠を確保してTrueを返す関数
+    def acquire(self):
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            return False
+        with self.lock:
+            self.pending += 1
+        return True
+
+    def release(self):
+        with self.lock:
+            self.pending -= 1
+        self.slots.release()
+
+    # 処理状況を辞書で返す関数
+    def status(self):
+        with self.lock:
+            pending, rejected = self.pending, self.rejected
+        snapshot = self.metrics.snapshot(pending, max(0, pending - self.workers))
+        snapshot.update({'workers': self.workers, 'rejected': rejected})
+        return snapshot
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+class MarkingRequestHandler(BaseHTTPRequestHandler):
+    # POST /process?<設定>に画像を送ると座標ファイルを返し、GET /statusで処理状況を返す
+    # (本文が空なら?path=<サーバー上の画像のパス>の画像を処理する)
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if urlsplit(self.path).path == '/status':
+            self.send_json(200, self.server.status())
+        else:
+            self.send_json(404, {'error': "見つかりません。"})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != '/process':
+            self.send_json(404, {'error': "見つかりません。"})
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # 本文の終わりが分からないため、接続も閉じる
+            self.close_connection = True
+            self.send_json(400, {'error': "Content-Lengthが不正です。"})
+            return
+        if length > self.server.max_bytes:
+            self.close_connection = True
+            self.send_json(413, {'error': f"画像が大きすぎます(上限{self.server.max_bytes}バイト)。"})
+            return
+        body = self.rfile.read(length)
+        try:
+            options, output_format = parse_query(url.query)
+        except ValueError as error:
+            self.send_json(400, {'error': str(error)})
+            return
+        source = body or parse_qs(url.query).get('path', [None])[-1]
+        if not source:
+            self.send_json(400, {'error': "画像が指定されていません。"})
+            return
+
+        # 受け付けられる数を超えていれば待たせずに断り、呼び出し側で再試行させる
+        if not self.server.acquire():
+            self.send_json(503, {'error': "処理待ちが上限に達しています。"}, {'Retry-After': '1'})
+            return
+        received = time.time()
+        try:
+            future = self.server.submit(process_request, source, options, output_format)
+            data, num_segments, records = future.result()
+        except BrokenProcessPool:
+            # 処理中にワーカープロセスが異常終了した(プールは次のリクエストで作り直す)
+            self.server.metrics.record(received, False)
+            self.send_json(500, {'error': "ワーカープロセスが異常終了しました。"})
+            return
+        except Exception as error:
+            self.server.metrics.record(received, False)
+            self.send_json(422, {'error': f"画像処理に失敗しました: {error}"})
+            return
+        finally:
+            self.server.release()
+        self.server.metrics.record(received, True, num_segments)
+
+        processing = total_seconds(records)
+        self.send_bytes(200, data, CONTENT_TYPES[output_format], {
+            'X-Segments': str(num_segments),
+            'X-Processing-Seconds': f"{processing:.4f}",
+            'X-Elapsed-Seconds': f"{time.time() - received:.4f}",
+        })
+
+    # JSONで応答する関数
+    def send_json(self, code, data, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_bytes(code, body, 'application/json; charset=utf-8', headers)
+
+    # バイト列で応答する関数
+    def send_bytes(self, code, body, content_type, headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        sys.stderr.write(f"{self.address_string()} - {format % args}\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="画像を受け取り座標ファイルを返すサーバーをlocalhostで起動する")
+    parser.add_argument('--host', default='127.0.0.1', help="待ち受けるアドレス(既定は同じマシンからのみ)")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1, help="ワーカープロセス数")
+    parser.add_argument('--queue-size', type=int, default=8,
+                        help="ワーカーの空きを待たせるリクエストの上限(超えたリクエストは503で断る)")
+    parser.add_argument('--cache-dir', help="処理結果を保存するディレクトリ(同じ画像・設定の2回目以降は保存した結果を返す)")
+    parser.add_argument('--max-bytes', type=int, default=256 * 1024 * 1024, help="受け付ける画像の大きさの上限[バイト]")
+    args = parser.parse_args(argv)
+    if args.workers < 1 or args.queue_size < 0:
+        parser.error("--workersは1以上、--queue-sizeは0以上を指定してください。")
+
+    server = MarkingServer((args.host, args.port), args.workers, args.queue_size, args.cache_dir, args.max_bytes)
+    start = time.perf_counter()
+    pids = server.warm_up()
+    print(f"待ち受け中: http://{args.host}:{server.server_port}/process "
+          f"(ワーカー{len(pids)}個, 起動{time.perf_counter() - start:.2f}秒)", flush=True)
+    # 終了のシグナルでもCtrl+Cと同じくワーカーを終了させてから止める
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("停止します。", file=sys.stderr)
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
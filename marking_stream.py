@@ -0,0 +1,150 @@
+import csv
+import sys
+
+import numpy as np
+from PIL import Image
+
+from marking_engine import (
+    crop_box, raw_layout, nearest_source, otsu_threshold, extract_runs, output_matrix, transform_segments,
+    write_segment_rows, OUTPUT_FIELD
+)
+
+
+class RowReader:
+    # 画像の指定した行をグレースケールで読み込むクラス
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.image = Image.open(file_path)
+        self.size = self.image.size
+        self.mode = self.image.mode
+        self.layout = raw_layout(self.image)
+        self.file = None
+        self.tiles = None
+        self.gray = None
+        if self.layout:
+            # 非圧縮の画像は必要な行だけをファイルから直接読む
+            self.file = open(file_path, 'rb')
+        elif len(getattr(self.image, 'tile', None) or ()) > 1 and self.can_decode_bands():
+            # タイル・ストリップ分割された画像は、読む行にかかるものだけを帯ごとにデコードする
+            self.tiles = list(self.image.tile)
+        else:
+            # 途中から読めない画像(PNG・JPEG・圧縮TIFFなど)は、グレースケールで1回だけ全体をデコードする
+            print(f"警告: {file_path}は行ごとに読めない形式のため画像全体をデコードします"
+                  f"(メモリ使用量は画像サイズに比例します)。", file=sys.stderr)
+            self.gray = np.asarray(self.image.convert('L'))
+
+    # 指定した行を(行数, 幅)のグレースケール配列として返す関数
+    def read_rows(self, rows):
+        if self.gray is not None:
+            return self.gray[rows]
+        if self.tiles is not None:
+            top, band = self.decode_band(int(rows[0]), int(rows[-1]) + 1)
+            return band[rows - top]
+
+        offset, stride = self.layout
+        buffer = np.empty((len(rows), stride), dtype=np.uint8)
+        for i, y in enumerate(rows):
+            self.file.seek(offset + int(y) * stride)
+            self.file.readinto(memoryview(buffer[i]))
+        if self.mode == 'L':
+            return buffer
+        rgb_image = Image.frombuffer('RGB', (self.size[0], len(rows)), buffer, 'raw', 'RGB', 0, 1)
+        return np.asarray(rgb_image.convert('L'))
+
+    # 帯ごとのデコードに使うPillowの内部属性があり、先頭の帯を正しくデコードできるかを確かめる関数
+    # (Pillowの版によって使えない場合は、画像全体をデコードする方法に切り替える)
+    def can_decode_bands(self):
+        tiles = list(self.image.tile)
+        if not hasattr(self.image, '_size') or not all(hasattr(tile, '_replace') for tile in tiles):
+            return False
+        first = tiles[0][1]
+        try:
+            top, band = self.decode_band(first[1], first[3], tiles)
+        except (AttributeError, TypeError, ValueError, OSError):
+            return False
+        return band.shape[1] == self.size[0] and top <= first[1] < top + len(band)
+
+    # top〜bottom行にかかるタイルだけをデコードし、(先頭行, グレースケール配列)を返す関数
+    def decode_band(self, top, bottom, tiles=None):
+        tiles = [tile for tile in tiles or self.tiles if tile[1][1] < bottom and tile[1][3] > top]
+        top, bottom = min(tile[1][1] for tile in tiles), max(tile[1][3] for tile in tiles)
+        with Image.open(self.file_path) as image:
+            # 帯の大きさの画像として開き直し、タイルの位置を帯の先頭からの位置にずらす
+            image._size = (self.size[0], bottom - top)
+            image.tile = [tile._replace(extents=(tile[1][0], tile[1][1] - top, tile[1][2], tile[1][3] - top))
+                          for tile in tiles]
+            return top, np.asarray(image.convert('L'))
+
+    def close(self):
+        if self.file:
+            self.file.close()
+        self.image.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class StreamingProcessor:
+    # 画像を帯ごとに切り出し・反転・2値化・粗くして塗りつぶしの座標を出力するクラス
+    # (ImageProcessor.process_imageと同じ結果を、画像サイズによらない一定のメモリで求める)
+    def __init__(self, reader, threshold=30, factor=10, strip_rows=256, polarity='black'):
+        self.reader = reader
+        self.threshold = threshold
+        self.factor = factor
+        self.polarity = polarity
+        self.strip_rows = strip_rows  # 1つの帯に含める粗い画像の行数(元画像ではstrip_rows*factor行)
+
+        left, top, right, bottom = (int(round(value)) for value in crop_box(reader.size))
+        crop_width, crop_height = right - left, bottom - top
+        self.crop = (left, top, right, bottom)
+        self.coarse_size = (crop_width // factor, crop_height // factor)
+
+        # NEARESTで粗くする際に参照される画素だけを読めばよい(左右反転も列の対応で行う)
+        self.columns = left + (crop_width - 1 - nearest_source(crop_width, self.coarse_size[0]))
+        self.rows = top + nearest_source(crop_height, self.coarse_size[1])
+
+    # 粗い画像を帯ごとに(先頭行, グレースケール配列)で返すジェネレーター
+    def iter_strips(self):
+        for start in range(0, self.coarse_size[1], self.strip_rows):
+            rows = self.rows[start:start + self.strip_rows]
+            yield start, self.reader.read_rows(rows)[:, self.columns]
+
+    # 自動しきい値の場合は切り出した範囲全体のヒストグラムから求める関数
+    # (ImageProcessorと同じしきい値になるよう、粗くする前の全ての画素を帯ごとに数える)
+    def resolve_threshold(self):
+        if self.threshold is not None:
+            return self.threshold
+        left, top, right, bottom = self.crop
+        band_rows = self.strip_rows * self.factor
+        histogram = np.zeros(256, dtype=np.int64)
+        for start in range(top, bottom, band_rows):
+            band = self.reader.read_rows(np.arange(start, min(start + band_rows, bottom)))
+            histogram += np.bincount(band[:, left:right].ravel(), minlength=256)
+        return otsu_threshold(histogram)
+
+    # 帯ごとの塗りつぶしの座標を(N, 4)のint32配列で返すジェネレーター
+    def iter_runs(self):
+        threshold = self.resolve_threshold()
+        for start, strip in self.iter_strips():
+            runs = extract_runs(strip > threshold, self.polarity)
+            runs[:, 1] += start
+            runs[:, 3] += start
+            yield runs
+
+
+# 帯ごとの座標を変換しながらcsvファイルに書き出す関数
+def stream_to_csv(file_path, csv_file_path, threshold=30, factor=10, strip_rows=256, output_field=OUTPUT_FIELD,
+                  polarity='black'):
+    with RowReader(file_path) as reader, open(csv_file_path, mode='w', newline='', buffering=1 << 20) as file:
+        processor = StreamingProcessor(reader, threshold, factor, strip_rows, polarity)
+        matrix = output_matrix(processor.coarse_size, **output_field)
+        writer = csv.writer(file)
+        writer.writerow(['Index', 'X1', 'Y1', 'X2', 'Y2'])
+        index = 0
+        for runs in processor.iter_runs():
+            write_segment_rows(writer, transform_segments(runs, matrix), index)
+            index += len(runs)
+    return index
@@ -0,0 +1,155 @@
+import atexit
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from PIL import Image
+
+from marking_engine import (
+    check_factor, otsu_threshold, nearest_source, nearest_edges, block_edges, block_sums, extract_runs, expand_runs
+)
+
+
+# 帯ごとの処理を行うプロセスプール(起動に時間がかかるため、プロセス数が変わるまで使い回す)
+tile_pool = {'workers': None, 'executor': None}
+tile_pool_lock = threading.Lock()
+
+
+# 帯ごとの処理を行うプロセスプールを返す関数(プロセス数が変わったら古いプールを終了してから作り直す)
+# (tile_pool_lockを取得して呼ぶ)
+def tile_executor(workers):
+    if tile_pool['executor'] is None or tile_pool['workers'] != workers:
+        if tile_pool['executor'] is not None:
+            tile_pool['executor'].shutdown(wait=True)
+        # GUIのスレッドから呼ばれても安全なようにforkではなくspawnで起動する
+        tile_pool['executor'] = ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'))
+        tile_pool['workers'] = workers
+    return tile_pool['executor']
+
+
+# 帯ごとの処理をプロセスプールに投入する関数(投入中に別のスレッドがプールを作り直さないようロックする)
+def submit_bands(workers, task, bounds):
+    with tile_pool_lock:
+        executor = tile_executor(workers)
+        return [executor.submit(process_band, task, top, bottom) for top, bottom in bounds]
+
+
+# プロセスプールを終了する関数(終了時に子プロセスを残さないようatexitに登録する)
+def shutdown_tile_executor():
+    with tile_pool_lock:
+        if tile_pool['executor'] is not None:
+            tile_pool['executor'].shutdown(wait=True)
+        tile_pool['workers'] = tile_pool['executor'] = None
+
+
+atexit.register(shutdown_tile_executor)
+
+
+# 子プロセスで親プロセスが作った共有メモリを開く関数(削除は親プロセスが行う)
+def attach_shared_memory(name):
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name=name, track=False)
+    # spawnした子プロセスは親と同じresource_trackerを使うため、登録が重複しても親の削除で1回だけ解除される
+    return SharedMemory(name=name)
+
+
+# 粗い画像の行を帯に分け、各帯の(先頭行, 末尾行+1)を求める関数
+def band_bounds(coarse_height, bands):
+    bounds = np.linspace(0, coarse_height, min(bands, coarse_height) + 1).astype(int)
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+# 粗くする方法に応じて、粗い格子の各画素が参照する範囲を求める関数
+def coarse_layout(size, mode, factor):
+    width, height = size
+    if mode == 'nearest':
+        factor = check_factor(factor, mode)
+        coarse_width, coarse_height = max(1, width // factor), max(1, height // factor)
+        sample = (nearest_source(height, coarse_height), nearest_source(width, coarse_width))
+        return sample, (nearest_edges(coarse_width, width), nearest_edges(coarse_height, height))
+    return None, (block_edges(width, factor), block_edges(height, factor))
+
+
+# 1つの帯のグレースケール画素を2値化して粗くし、白のブール配列を返す関数
+def coarsen_band(gray, top, bottom, task):
+    threshold, (col_edges, row_edges) = task['threshold'], task['edges']
+    if task['mode'] == 'nearest':
+        # 粗い画像に残る画素だけを2値化する
+        rows, columns = task['sample']
+        return gray[np.ix_(rows[top:bottom], columns)] > threshold
+
+    band_edges = row_edges[top:bottom + 1]
+    pixels = gray[band_edges[0]:band_edges[-1]]
+    if task['mode'] == 'area':
+        factor = task['factor']
+        if float(factor).is_integer():
+            # 帯の境界はfactorの倍数なので、画像全体をreduceした場合と同じ平均になる
+            return np.asarray(Image.fromarray(pixels).reduce(int(factor))) > threshold
+        sums, counts = block_sums(pixels, col_edges, band_edges - band_edges[0])
+        return sums > threshold * counts
+    sums, counts = block_sums(pixels > threshold, col_edges, band_edges - band_edges[0])
+    return 2 * sums.astype(np.int64) > counts
+
+
+# 共有メモリ上の1つの帯を処理し、粗い画像を共有メモリに書き込んで塗りの座標を返す関数(子プロセスで実行)
+def process_band(task, top, bottom):
+    gray_memory = attach_shared_memory(task['gray'])
+    mask_memory = attach_shared_memory(task['mask'])
+    try:
+        return write_band(gray_memory, mask_memory, task, top, bottom)
+    finally:
+        gray_memory.close()
+        mask_memory.close()
+
+
+# 帯を粗くして書き込み、塗りの座標を全体の行番号で求める関数
+def write_band(gray_memory, mask_memory, task, top, bottom):
+    gray = np.ndarray(task['gray_shape'], dtype=np.uint8, buffer=gray_memory.buf)
+    mask = np.ndarray(task['mask_shape'], dtype=np.bool_, buffer=mask_memory.buf)
+    white = coarsen_band(gray, top, bottom, task)
+    mask[top:bottom] = white
+
+    runs = extract_runs(white, task['polarity'])
+    runs[:, 1] += top
+    runs[:, 3] += top
+    if task['expand']:
+        coarse_size = (task['mask_shape'][1], task['mask_shape'][0])
+        runs = expand_runs(runs, coarse_size, task['full_size'], task['edges'])
+    return runs
+
+
+# 切り出した画像を粗い行の帯に分けてプロセスプールで2値化・粗くする・塗りの抽出を行う関数
+# (画素は共有メモリで受け渡す。粗い白のブール配列, ブロックの境界, 塗りの座標, 使用したしきい値を返す)
+def tile_transitions(grayscale_image, threshold, factor, mode='nearest', polarity='black', expand=True, workers=2):
+    if threshold is None:
+        threshold = otsu_threshold(grayscale_image.histogram())
+    width, height = grayscale_image.size
+    sample, edges = coarse_layout((width, height), mode, factor)
+    mask_shape = (len(edges[1]) - 1, len(edges[0]) - 1)
+
+    gray_memory = SharedMemory(create=True, size=max(1, width * height))
+    mask_memory = SharedMemory(create=True, size=max(1, mask_shape[0] * mask_shape[1]))
+    try:
+        gray = np.ndarray((height, width), dtype=np.uint8, buffer=gray_memory.buf)
+        gray[:] = np.asarray(grayscale_image)
+        del gray
+
+        task = {
+            'gray': gray_memory.name, 'gray_shape': (height, width), 'mask': mask_memory.name,
+            'mask_shape': mask_shape, 'mode': mode, 'factor': factor, 'threshold': threshold,
+            'sample': sample, 'edges': edges, 'polarity': polarity, 'expand': expand,
+            'full_size': (width, height),
+        }
+        futures = submit_bands(workers, task, band_bounds(mask_shape[0], workers))
+        # 帯は上から順に並んでいるため、つなげるだけで全体の行順になる
+        runs = np.concatenate([future.result() for future in futures])
+        white = np.ndarray(mask_shape, dtype=np.bool_, buffer=mask_memory.buf).copy()
+    finally:
+        gray_memory.close()
+        gray_memory.unlink()
+        mask_memory.close()
+        mask_memory.unlink()
+    return white, edges, runs, threshold
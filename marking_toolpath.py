@@ -0,0 +1,142 @@
+import numpy as np
+
+
+# 座標にアフィン行列を適用する関数(丸めずに距離の計算に使う)
+def project_segments(segments, matrix=None):
+    segments = np.asarray(segments, dtype=np.float64).reshape(-1, 4)
+    if matrix is None:
+        return segments
+    points = segments.reshape(-1, 2) @ matrix[:2, :2].T + matrix[:2, 2]
+    return points.reshape(-1, 4)
+
+
+# 線分の終点から次の線分の始点までの移動距離の合計を求める関数(matrixがあれば出力座標で測る)
+def travel_distance(segments, matrix=None):
+    points = project_segments(segments, matrix)
+    moves = points[1:, :2] - points[:-1, 2:]
+    return float(np.hypot(moves[:, 0], moves[:, 1]).sum())
+
+
+# 塗りを1行ごとに左右交互の向きで並べる関数(戻りの行は始点と終点のXを入れ替える)
+def serpentine_order(runs):
+    runs = np.asarray(runs)
+    if len(runs) < 2:
+        return runs
+    row_rank = np.unique(runs[:, 1], return_inverse=True)[1].reshape(-1)
+    backward = row_rank % 2 == 1
+    order = np.lexsort((np.where(backward, -runs[:, 0], runs[:, 0]), runs[:, 1]))
+    ordered = runs[order]
+    backward = backward[order]
+    ordered[backward] = ordered[backward][:, [2, 1, 0, 3]]
+    return ordered
+
+
+# 矩形(x1, 上端, x2, 下端)を1行ごとの塗りの線分に展開する関数
+# (矩形ごとに上の行から続けて出力し、serpentineなら矩形の中でも左右交互の向きにする)
+def blocks_to_rows(blocks, serpentine=False):
+    blocks = np.asarray(blocks).reshape(-1, 4)
+    heights = blocks[:, 3] - blocks[:, 1] + 1
+    index = np.repeat(np.arange(len(blocks)), heights)
+    offsets = np.arange(len(index)) - np.repeat(np.cumsum(heights) - heights, heights)
+    rows = blocks[index]
+    rows[:, 1] = rows[:, 3] = rows[:, 1] + offsets
+    if serpentine:
+        flipped = offsets % 2 == 1
+        rows[flipped] = rows[flipped][:, [2, 1, 0, 3]]
+    return rows
+
+
+# 終点と次の始点がつながっている線分をひとまとまりの経路とし、各経路の(先頭, 末尾+1)を求める関数
+def split_chains(segments):
+    segments = np.asarray(segments)
+    connected = (segments[:-1, 2:] == segments[1:, :2]).all(axis=1)
+    starts = np.flatnonzero(np.concatenate([[True], ~connected]))
+    ends = np.append(starts[1:], len(segments))
+    return starts, ends
+
+
+# 経路の順序と向きを、直前の位置から最も近い経路を選ぶ方法で決める関数
+def nearest_neighbor_tour(entries, exits, position):
+    count = len(entries)
+    order = np.empty(count, dtype=np.int64)
+    flipped = np.zeros(count, dtype=bool)
+    remaining = np.ones(count, dtype=bool)
+    for step in range(count):
+        forward = np.hypot(*(entries - position).T)
+        backward = np.hypot(*(exits - position).T)
+        forward[~remaining] = np.inf
+        backward[~remaining] = np.inf
+        best_forward, best_backward = forward.argmin(), backward.argmin()
+        if backward[best_backward] < forward[best_forward]:
+            order[step], flipped[step] = best_backward, True
+            position = entries[best_backward]
+        else:
+            order[step] = best_forward
+            position = exits[best_forward]
+        remaining[order[step]] = False
+    return order, flipped
+
+
+# 区間の順序と向きを反転して移動距離が短くなる限り経路を改善する関数(2-opt)
+def two_opt_tour(entries, exits, position, order, flipped, max_passes=10):
+    order, flipped = order.copy(), flipped.copy()
+    count = len(order)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(count):
+            # 向きを考慮した各経路の入口・出口
+            entry = np.where(flipped[:, None], exits[order], entries[order])
+            exit_ = np.where(flipped[:, None], entries[order], exits[order])
+            previous = exit_[i - 1] if i else position
+
+            # i〜jを反転したときの距離の変化(j+1が無い場合は後ろの移動が無くなる)
+            j = np.arange(i, count)
+            following = np.vstack([entry[i + 1:], np.full((1, 2), np.nan)])
+            removed = np.hypot(*(entry[i] - previous)) + np.nan_to_num(np.hypot(*(following - exit_[j]).T))
+            added = np.hypot(*(exit_[j] - previous).T) + np.nan_to_num(np.hypot(*(following - entry[i]).T))
+            delta = added - removed
+            best = delta.argmin()
+            if delta[best] < -1e-9:
+                end = i + best + 1
+                order[i:end] = order[i:end][::-1]
+                flipped[i:end] = ~flipped[i:end][::-1]
+                improved = True
+        if not improved:
+            break
+    return order, flipped
+
+
+# 輪郭の線分を経路単位で並べ替え、必要なら向きを反転する関数(methodは'nearest'または'2opt')
+def order_chains(segments, matrix=None, start=(0.0, 0.0), method='nearest'):
+    segments = np.asarray(segments)
+    if len(segments) < 2:
+        return segments
+    starts, ends = split_chains(segments)
+    measured = project_segments(segments, matrix)
+    entries, exits = measured[starts, :2], measured[ends - 1, 2:]
+
+    order, flipped = nearest_neighbor_tour(entries, exits, np.asarray(start, dtype=np.float64))
+    if method == '2opt':
+        order, flipped = two_opt_tour(entries, exits, np.asarray(start, dtype=np.float64), order, flipped)
+
+    # 経路ごとの線分の位置を並べた添字で一括して組み直す
+    lengths = ends[order] - starts[order]
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    reverse = np.repeat(flipped, lengths)
+    index = np.repeat(starts[order], lengths) + np.where(reverse, np.repeat(lengths, lengths) - 1 - offsets, offsets)
+    ordered = segments[index]
+    ordered[reverse] = ordered[reverse][:, [2, 3, 0, 1]]
+    return ordered
+
+
+# 塗りと輪郭の線分の出力順を決める関数(fill_orderは'raster'または'serpentine', contour_orderは'none', 'nearest', '2opt')
+# (blocksなら塗りは矩形で、矩形の順に並べてから1行ごとの線分に展開する)
+def schedule_segments(fills, contours, fill_order='raster', contour_order='none', matrix=None, blocks=False):
+    if fill_order == 'serpentine':
+        fills = serpentine_order(fills)
+    if blocks:
+        fills = blocks_to_rows(fills, fill_order == 'serpentine')
+    if contour_order != 'none' and len(contours):
+        start = project_segments(fills[-1:], matrix)[0, 2:] if len(fills) else project_segments(contours[:1], matrix)[0, :2]
+        contours = order_chains(contours, matrix, start, contour_order)
+    return np.concatenate([fills, contours])
@@ -0,0 +1,283 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from marking_batch import DEFAULT_OPTIONS, IMAGE_EXTENSIONS, process_file
+from marking_engine import check_factor
+from marking_profile import append_jsonl
+from marking_writers import WRITERS
+
+# 監視の設定の既定値(画像処理の設定はmarking_batch.DEFAULT_OPTIONSと同じキーをoptionsに書く)
+DEFAULT_CONFIG = {
+    'input': None,  # 監視するディレクトリ
+    'output': None,  # 座標ファイルの出力先(省略時は<input>/output)
+    'done': None,  # 処理済みの画像の移動先(省略時は<input>/done)
+    'failed': None,  # 失敗した画像の移動先(省略時は<input>/failed)
+    'workers': 2,  # ワーカープロセス数
+    'queue_size': 8,  # 同時に処理待ちにする画像の上限(超えた分は次の確認まで入力フォルダに残す)
+    'poll_interval': 1.0,  # 入力フォルダを確認する間隔[秒]
+    'metrics': None,  # 処理状況を書き出すJSONファイル(省略時は<output>/metrics.json)
+    'options': {},
+}
+
+
+# 設定ファイル(JSON)を読み込み、既定値を補う関数
+def load_config(config_path=None, **overrides):
+    config = {**DEFAULT_CONFIG, 'options': {}}
+    if config_path:
+        with open(config_path, encoding='utf-8') as file:
+            config.update(json.load(file))
+    config.update({key: value for key, value in overrides.items() if value is not None})
+
+    if not config['input']:
+        raise ValueError("監視するディレクトリ(input)が指定されていません。")
+    for key in ('output', 'done', 'failed'):
+        config[key] = config[key] or os.path.join(config['input'], key)
+    config['metrics'] = config['metrics'] or os.path.join(config['output'], 'metrics.json')
+
+    unknown = set(config['options']) - set(DEFAULT_OPTIONS)
+    if unknown:
+        raise ValueError(f"未対応の設定です: {', '.join(sorted(unknown))}")
+    options = {**DEFAULT_OPTIONS, **config['options']}
+    options['factor'] = check_factor(options['factor'], options['coarsen_mode'])
+    if options['simplify_tolerance'] < 0:
+        raise ValueError("simplify_toleranceは0以上の値を指定してください。")
+    options['formats'] = tuple(options['formats'])
+    unknown = [name for name in options['formats'] if name not in WRITERS]
+    if unknown or not options['formats']:
+        raise ValueError(f"未対応の出力形式です: {', '.join(unknown)}")
+    if options['stream'] and options['formats'] != ('csv',):
+        raise ValueError("streamではcsv形式のみ出力できます。")
+    if options['stream'] and (options['fill_mode'] != 'rows' or options['fill_order'] != 'raster'
+                              or options['coarsen_mode'] != 'nearest'):
+        raise ValueError("streamではfill_mode rows, fill_order raster, coarsen_mode nearestのみ使用できます。")
+    config['options'] = options
+    return config
+
+
+# 一時ディレクトリに出力してから出力先に移し、書きかけのファイルが見えないようにする関数(ワーカープロセスで実行)
+def process_atomically(image_path, output_dir, options):
+    temporary_dir = tempfile.mkdtemp(prefix='.part-', dir=output_dir)
+    try:
+        _, num_segments, records, _ = process_file(image_path, temporary_dir, options)
+        output_paths = []
+        for name in sorted(os.listdir(temporary_dir)):
+            output_path = os.path.join(output_dir, name)
+            os.replace(os.path.join(temporary_dir, name), output_path)
+            output_paths.append(output_path)
+        return output_paths, num_segments, records
+    finally:
+        shutil.rmtree(temporary_dir, ignore_errors=True)
+
+
+# 同名のファイルがあれば時刻を付けた名前でファイルを移動する関数
+def move_unique(file_path, directory):
+    stem, extension = os.path.splitext(os.path.basename(file_path))
+    target = os.path.join(directory, stem + extension)
+    if os.path.exists(target):
+        target = os.path.join(directory, f"{stem}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}{extension}")
+    shutil.move(file_path, target)
+    return target
+
+
+# JSONファイルを書き換える関数(一時ファイルに書いてから置き換える)
+def write_json_atomically(file_path, data):
+    temporary_path = f"{file_path}.tmp"
+    with open(temporary_path, 'w', encoding='utf-8') as file:
+        json.dump(data, file, ensure_ascii=False, indent=2)
+    os.replace(temporary_path, file_path)
+
+
+class Metrics:
+    # 処理待ちの数・処理時間・スループットを集計するクラス(marking_serverでも使う)
+    def __init__(self, window=100):
+        self.started = time.time()
+        self.processed = 0
+        self.failed = 0
+        self.segments = 0
+        self.latencies = deque(maxlen=window)  # 検出(受付)から出力完了までの時間[秒]
+        self.finished = deque(maxlen=window)  # 完了した時刻
+
+    # 1枚の処理結果を記録する関数
+    def record(self, detected, succeeded, num_segments=0):
+        now = time.time()
+        self.latencies.append(now - detected)
+        self.finished.append(now)
+        if succeeded:
+            self.processed += 1
+            self.segments += num_segments
+        else:
+            self.failed += 1
+
+    # 現在の処理状況を辞書で返す関数
+    def snapshot(self, queued, waiting):
+        now = time.time()
+        latencies = sorted(self.latencies)
+        recent = [finished for finished in self.finished if now - finished <= 60]
+        return {
+            'time': now,
+            'uptime': now - self.started,
+            'queue_depth': queued,  # ワーカーで処理中・処理待ちの画像の数
+            'waiting': waiting,  # まだワーカーに渡していない画像の数
+            'processed': self.processed,
+            'failed': self.failed,
+            'segments': self.segments,
+            'latency_mean': sum(latencies) / len(latencies) if latencies else None,
+            'latency_p95': latencies[int(0.95 * (len(latencies) - 1))] if latencies else None,
+            'throughput_per_minute': len(recent),
+        }
+
+
+class FolderWatcher:
+    # 入力フォルダを定期的に確認し、新しい画像をワーカープロセスで処理するクラス
+    def __init__(self, config):
+        self.config = config
+        for key in ('output', 'done', 'failed'):
+            os.makedirs(config[key], exist_ok=True)
+        self.executor = ProcessPoolExecutor(max_workers=config['workers'])
+        self.pending = {}  # future -> (画像のパス, 検出した時刻)
+        self.sizes = {}  # まだキューに入れていない画像の(サイズ, 更新時刻)と検出した時刻
+        self.unmovable = {}  # 処理後に移動できず入力フォルダに残った画像の(サイズ, 更新時刻)
+        self.metrics = Metrics()
+
+    # 入力フォルダの画像のうち、書き込みが終わったもの(前回の確認からサイズ・更新時刻が変わらないもの)を返す関数
+    def scan(self):
+        queued = {image_path for image_path, _ in self.pending.values()}
+        ready = []
+        current = {}
+        unmovable = {}
+        for entry in sorted(os.scandir(self.config['input']), key=lambda entry: entry.name):
+            if not entry.is_file() or not entry.name.lower().endswith(IMAGE_EXTENSIONS) or entry.path in queued:
+                continue
+            stat = entry.stat()
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if self.unmovable.get(entry.path) == signature:
+                # 処理済みで移動できなかった画像は、書き換えられるまで処理し直さない
+                unmovable[entry.path] = signature
+                continue
+            previous = self.sizes.get(entry.path)
+            detected = previous[1] if previous else time.time()
+            current[entry.path] = (signature, detected)
+            if previous and previous[0] == signature:
+                ready.append((entry.path, detected))
+        self.sizes = current
+        self.unmovable = unmovable
+        return ready
+
+    # 処理待ちの上限まで画像をワーカーに渡す関数
+    def submit(self, ready):
+        for image_path, detected in ready:
+            if len(self.pending) >= self.config['queue_size']:
+                break
+            task = (process_atomically, image_path, self.config['output'], self.config['options'])
+            try:
+                future = self.executor.submit(*task)
+            except BrokenProcessPool:
+                # ワーカープロセスが異常終了したプールは使えないため、作り直して渡し直す
+                # (異常終了時に処理中だった画像は、プールがBrokenProcessPoolで失敗させる)
+                self.restart_executor()
+                future = self.executor.submit(*task)
+            self.pending[future] = (image_path, detected)
+            del self.sizes[image_path]
+
+    # 使えなくなったプールを作り直す関数
+    def restart_executor(self):
+        print("ワーカープロセスが異常終了したため、作り直します。", file=sys.stderr, flush=True)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = ProcessPoolExecutor(max_workers=self.config['workers'])
+
+    # 完了した画像を処理済み・失敗のフォルダに移す関数
+    def collect(self):
+        for future in [future for future in self.pending if future.done()]:
+            image_path, detected = self.pending.pop(future)
+            error = future.exception()
+            if error is None:
+                output_paths, num_segments, records = future.result()
+                self.move_image(image_path, 'done')
+                self.metrics.record(detected, True, num_segments)
+                if self.config['options']['profile_log']:
+                    append_jsonl(self.config['options']['profile_log'], {'image': image_path, 'output': ', '.join(output_paths),
+                                                                          'segments': num_segments, 'stages': records})
+                print(f"{image_path} -> {', '.join(output_paths)} ({num_segments}行)", flush=True)
+            else:
+                failed_path = self.move_image(image_path, 'failed')
+                if failed_path:
+                    with open(failed_path + '.error.txt', 'w', encoding='utf-8') as file:
+                        file.write(''.join(traceback.format_exception(type(error), error, error.__traceback__)))
+                self.metrics.record(detected, False)
+                print(f"失敗: {image_path}: {error}", file=sys.stderr, flush=True)
+
+    # 画像を処理済み・失敗のフォルダに移す関数(処理中に画像が消された場合なども監視は続け、移動先のパスかNoneを返す)
+    def move_image(self, image_path, key):
+        try:
+            return move_unique(image_path, self.config[key])
+        except OSError as error:
+            print(f"警告: {image_path}を{self.config[key]}に移動できません: {error}", file=sys.stderr, flush=True)
+            try:
+                stat = os.stat(image_path)
+                self.unmovable[image_path] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                pass  # 画像が消えていれば次の確認でも見つからない
+            return None
+
+    # 処理状況をファイルに書き出す関数
+    def write_metrics(self):
+        snapshot = self.metrics.snapshot(len(self.pending), len(self.sizes))
+        write_json_atomically(self.config['metrics'], snapshot)
+        return snapshot
+
+    # 入力フォルダの確認・完了した画像の後処理を1回行う関数
+    def step(self):
+        self.collect()
+        self.submit(self.scan())
+        return self.write_metrics()
+
+    # 停止するまで監視を続ける関数(onceなら入力フォルダが空になった時点で終了する)
+    def run(self, once=False):
+        try:
+            while True:
+                snapshot = self.step()
+                if once and not self.pending and not snapshot['waiting']:
+                    break
+                time.sleep(self.config['poll_interval'])
+        except KeyboardInterrupt:
+            print("停止します。処理中の画像の完了を待っています…", file=sys.stderr)
+        finally:
+            self.executor.shutdown(wait=True)
+            self.collect()
+            self.write_metrics()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="入力フォルダを監視し、追加された画像の座標ファイルを自動で出力する")
+    parser.add_argument('input', nargs='?', help="監視するディレクトリ(設定ファイルのinputより優先)")
+    parser.add_argument('-c', '--config', help="設定ファイル(JSON)")
+    parser.add_argument('-o', '--output', help="座標ファイルの出力先")
+    parser.add_argument('-j', '--workers', type=int, help="ワーカープロセス数")
+    parser.add_argument('--queue-size', type=int, help="同時に処理待ちにする画像の上限")
+    parser.add_argument('--interval', type=float, dest='poll_interval', help="入力フォルダを確認する間隔[秒]")
+    parser.add_argument('--once', action='store_true', help="入力フォルダの画像を処理し終えたら終了する")
+    args = parser.parse_args(argv)
+
+    try:
+        config = load_config(args.config, input=args.input, output=args.output, workers=args.workers,
+                             queue_size=args.queue_size, poll_interval=args.poll_interval)
+    except (OSError, ValueError) as error:
+        parser.error(str(error))
+
+    print(f"監視中: {config['input']} -> {config['output']} (処理状況: {config['metrics']})", flush=True)
+    watcher = FolderWatcher(config)
+    watcher.run(args.once)
+    return 1 if watcher.metrics.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
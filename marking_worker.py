@@ -0,0 +1,128 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class BackgroundJob:
+    # 画像処理をワーカースレッドで実行し、結果をroot.afterでメインスレッドに戻すクラス
+    def __init__(self, root, poll_interval=16):
+        self.root = root
+        self.poll_interval = poll_interval  # 約60fpsで結果を確認する
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.events = queue.Queue()
+        self.generation = 0
+        self.cancel_event = threading.Event()
+        self.handlers = None
+        self.polling = False
+
+    # 処理中のジョブがあるかを返す関数
+    @property
+    def busy(self):
+        return self.handlers is not None
+
+    # ジョブを登録する関数(実行中の古いジョブは中止する)
+    def submit(self, function, on_done, on_progress=None, on_error=None):
+        self.cancel()
+        self.generation += 1
+        generation = self.generation
+        cancel_event = threading.Event()
+        self.cancel_event = cancel_event
+        self.handlers = (on_done, on_progress, on_error)
+
+        # 工程の区切りで中止の確認と進捗の通知を行う関数
+        def checkpoint(step, total, message=""):
+            if cancel_event.is_set():
+                raise JobCancelled()
+            self.events.put((generation, 'progress', (step, total, message)))
+
+        def run():
+            try:
+                result = function(checkpoint)
+            except JobCancelled:
+                return
+            except Exception as error:
+                self.events.put((generation, 'error', error))
+                return
+            self.events.put((generation, 'done', result))
+
+        self.executor.submit(run)
+        if not self.polling:
+            self.polling = True
+            self.root.after(self.poll_interval, self.poll)
+
+    # 実行中のジョブを中止する関数
+    def cancel(self):
+        self.cancel_event.set()
+        self.handlers = None
+
+    # ワーカーからの通知を定期的に確認する関数
+    def poll(self):
+        try:
+            self.dispatch_events()
+        finally:
+            if self.busy:
+                self.root.after(self.poll_interval, self.poll)
+            else:
+                self.polling = False
+
+    # ワーカーからの通知をメインスレッドで処理する関数
+    def dispatch_events(self):
+        while True:
+            try:
+                generation, kind, payload = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if generation != self.generation or self.handlers is None:
+                continue  # 中止済みの古いジョブの通知は捨てる
+            on_done, on_progress, on_error = self.handlers
+            if kind == 'progress':
+                if on_progress:
+                    on_progress(*payload)
+            elif kind == 'done':
+                self.handlers = None
+                on_done(payload)
+            else:
+                self.handlers = None
+                if on_error:
+                    on_error(payload)
+                else:
+                    raise payload
+
+    # ワーカースレッドを終了する関数
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False)
+
+
+class Debouncer:
+    # 連続した呼び出しをまとめ、最後の呼び出しからdelay[ms]後に1回だけ実行するクラス
+    def __init__(self, root, delay, callback):
+        self.root = root
+        self.delay = delay
+        self.callback = callback
+        self.after_id = None
+
+    # 呼び出しを予約し直す関数
+    def trigger(self):
+        self.cancel()
+        self.after_id = self.root.after(self.delay, self.fire)
+
+    def fire(self):
+        self.after_id = None
+        self.callback()
+
+    # 予約済みの呼び出しを取り消す関数
+    def cancel(self):
+        if self.after_id is not None:
+            self.root.after_cancel(self.after_id)
+            self.after_id = None
+
+    # 予約済みの呼び出しがあれば直ちに実行する関数
+    def flush(self):
+        if self.after_id is not None:
+            self.cancel()
+            self.callback()
@@ -0,0 +1,105 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+from marking_engine import write_segments_csv
+
+# バイナリ形式のヘッダー: 識別子, バージョン, フラグ, 線分数, 回転角度[度], X縮尺, Y縮尺, Xオフセット, Yオフセット
+# (バージョン1は回転角度がなく、フラグは予約で0)
+BINARY_MAGIC = b'ZHYB'
+BINARY_VERSION = 2
+BINARY_HEADERS = {1: struct.Struct('<4sHHIffff'), 2: struct.Struct('<4sHHIfffff')}
+BINARY_HEADER = BINARY_HEADERS[BINARY_VERSION]
+# フラグ: 座標は回転・縮尺・オフセットを適用済み(出力座標系の単位)で、ヘッダーの値は適用した変換を表す
+FLAG_TRANSFORMED = 1
+
+
+# 辞書形式の座標を(添字, (N, 4)の配列)に変換する関数
+def segments_to_array(segments):
+    if isinstance(segments, dict):
+        indices = np.fromiter(segments.keys(), dtype=np.int64, count=len(segments))
+        array = np.array(list(segments.values()), dtype=np.float64).reshape(-1, 4)
+        return indices, array
+    array = np.asarray(segments, dtype=np.float64).reshape(-1, 4)
+    return np.arange(len(array)), array
+
+
+# csvファイルに書き出す関数
+def write_csv(file_path, segments, metadata=None):
+    write_segments_csv(file_path, segments)
+
+
+# リトルエンディアンのfloat32を詰めたバイナリファイルに書き出す関数
+def write_binary(file_path, segments, metadata=None):
+    _, array = segments_to_array(segments)
+    angle, scale, offset, transformed = metadata_transform(metadata)
+    flags = FLAG_TRANSFORMED if transformed else 0
+    with open(file_path, 'wb') as file:
+        file.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, flags, len(array), angle, *scale, *offset))
+        file.write(array.astype('<f4').tobytes())
+
+
+# バイナリファイルを読み込む関数(バージョン1のファイルも読める)
+def read_binary(file_path):
+    with open(file_path, 'rb') as file:
+        magic, version = struct.unpack('<4sH', file.read(6))
+        if magic != BINARY_MAGIC or version not in BINARY_HEADERS:
+            raise ValueError(f"座標のバイナリファイルではありません: {file_path}")
+        header = BINARY_HEADERS[version]
+        file.seek(0)
+        values = header.unpack(file.read(header.size))
+        flags, count = values[2:4]
+        if version == 1:
+            # バージョン1は変換済みの座標だが回転角度を記録していない
+            angle, transform, transformed = None, values[4:], True
+        else:
+            angle, transform, transformed = values[4], values[5:], bool(flags & FLAG_TRANSFORMED)
+        array = np.frombuffer(file.read(count * 16), dtype='<f4').reshape(count, 4)
+    return array, {'angle': angle, 'scale': transform[:2], 'offset': transform[2:], 'transformed': transformed}
+
+
+# NumPyの.npyファイルにメモリマップで書き出す関数(メタデータは同名の.jsonに保存する)
+def write_npy(file_path, segments, metadata=None):
+    _, array = segments_to_array(segments)
+    angle, scale, offset, transformed = metadata_transform(metadata)
+    mapped = np.lib.format.open_memmap(file_path, mode='w+', dtype='<f4', shape=array.shape)
+    mapped[:] = array
+    mapped.flush()
+    del mapped
+    with open(os.path.splitext(file_path)[0] + '.json', 'w') as file:
+        json.dump({'angle': angle, 'scale': scale, 'offset': offset, 'transformed': transformed}, file)
+
+
+# 圧縮した.npzファイルにメタデータと一緒に書き出す関数
+def write_npz(file_path, segments, metadata=None):
+    _, array = segments_to_array(segments)
+    angle, scale, offset, transformed = metadata_transform(metadata)
+    np.savez_compressed(file_path, segments=array.astype('<f4'), angle=np.float32(angle),
+                        scale=np.array(scale, dtype='<f4'), offset=np.array(offset, dtype='<f4'),
+                        transformed=np.bool_(transformed))
+
+
+# メタデータから(回転角度, 縮尺, オフセット, 座標に適用済みか)を取り出す関数
+# (transformedがTrueなら座標は出力座標系の単位で、他の値は適用した変換を表す)
+def metadata_transform(metadata):
+    metadata = metadata or {}
+    return (float(metadata.get('angle', 0.0)), tuple(metadata.get('scale', (1.0, 1.0))),
+            tuple(metadata.get('offset', (0.0, 0.0))), bool(metadata.get('transformed', False)))
+
+
+WRITERS = {
+    'csv': write_csv,
+    'bin': write_binary,
+    'npy': write_npy,
+    'npz': write_npz,
+}
+
+
+# 出力形式(省略時は拡張子)に応じて座標を書き出す関数
+def write_segments(file_path, segments, metadata=None, output_format=None):
+    output_format = output_format or os.path.splitext(file_path)[1].lstrip('.').lower()
+    if output_format not in WRITERS:
+        raise ValueError(f"未対応の出力形式です: {output_format}")
+    WRITERS[output_format](file_path, segments, metadata)
@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from marking_engine import (
+    check_factor, block_edges, coarsen_area, coarsen_majority, coarsen_nearest, contour_segments,
+    merge_collinear_segments, merge_runs_into_blocks, output_matrix, output_transform, transform_segments
+)
+
+
+# 0〜255のランダムなグレースケール画像を作る関数
+def random_gray_image(width, height, seed):
+    rng = np.random.default_rng(seed)
+    return Image.fromarray(rng.integers(0, 256, (height, width), dtype=np.uint8), 'L')
+
+
+# ブロックごとに画素を1つずつ足し合わせる関数(粗くする処理の比較の基準)
+def baseline_block_means(pixels, col_edges, row_edges):
+    means = np.empty((len(row_edges) - 1, len(col_edges) - 1))
+    for i in range(len(row_edges) - 1):
+        for j in range(len(col_edges) - 1):
+            means[i, j] = pixels[row_edges[i]:row_edges[i + 1], col_edges[j]:col_edges[j + 1]].mean()
+    return means
+
+
+def test_check_factor():
+    assert check_factor(4.0) == 4 and isinstance(check_factor(4.0), int)
+    assert check_factor(2.5, 'area') == 2.5
+    with pytest.raises(ValueError):
+        check_factor(2.5, 'nearest')
+    with pytest.raises(ValueError):
+        check_factor(0.5, 'area')
+
+
+@pytest.mark.parametrize('length, factor', [(10, 3), (10, 2.5), (7, 1.5), (5, 8)])
+def test_block_edges_cover_the_whole_length(length, factor):
+    edges = block_edges(length, factor)
+    assert edges[0] == 0 and edges[-1] == length
+    assert (np.diff(edges) > 0).all()
+    assert len(edges) - 1 == int(np.ceil(length / factor))
+
+
+@pytest.mark.parametrize('factor', [2, 3, 2.5, 1.5])
+def test_area_matches_block_means(factor):
+    image = random_gray_image(23, 17, 1)
+    white, (col_edges, row_edges) = coarsen_area(image, factor, 128)
+    means = baseline_block_means(np.asarray(image, dtype=np.float64), col_edges, row_edges)
+    if float(factor).is_integer():
+        # PILのreduceは平均を整数に丸めるため、しきい値付近のブロックは比べない
+        clear = np.abs(means - 128) > 1
+        assert np.array_equal(white[clear], (means > 128)[clear])
+    else:
+        assert np.array_equal(white, means > 128)
+
+
+@pytest.mark.parametrize('factor', [2, 3, 2.5, 1.5])
+def test_majority_matches_block_votes(factor):
+    pixels = np.asarray(random_gray_image(23, 17, 2)) > 128
+    white, (col_edges, row_edges) = coarsen_majority(pixels, factor)
+    means = baseline_block_means(pixels.astype(np.float64), col_edges, row_edges)
+    # 同数の場合は黒になる
+    assert np.array_equal(white, means > 0.5)
+
+
+def test_majority_of_mode_1_image_matches_bool_array():
+    pixels = np.asarray(random_gray_image(20, 12, 3)) > 128
+    white, _ = coarsen_majority(Image.fromarray(pixels), 3)
+    assert np.array_equal(white, coarsen_majority(pixels, 3)[0])
+
+
+def test_nearest_matches_pil_resize():
+    image = random_gray_image(37, 23, 4)
+    white, _ = coarsen_nearest(np.asarray(image) > 128, 5)
+    expected = np.asarray(image.resize((37 // 5, 23 // 5), Image.NEAREST)) > 128
+    assert np.array_equal(white, expected)
+
+
+def test_output_matrix_maps_corners_to_field():
+    size = (200, 100)
+    matrix = output_matrix(size, angle=90, field=(20, 40), origin=(10, -20))
+    transform = output_transform(size, angle=90, field=(20, 40), origin=(10, -20))
+    assert transform['scale'] == (20 / 100, 40 / 200)
+    # 90度回転すると(x, y)は(-y, x)に移ってから縮尺・オフセットがかかる
+    segments = transform_segments([[0, 0, 200, 100]], matrix)
+    assert segments.tolist() == [[10.0, -20.0, 10.0 - 100 * 0.2, -20.0 + 200 * 0.2]]
+
+
+def test_transform_segments_rounds_once():
+    matrix = np.array([[1 / 3, 0, 0], [0, 1 / 3, 0], [0, 0, 1]])
+    segments = transform_segments(np.array([[1, 2, 3, 4]]), matrix, decimals=3)
+    assert segments.tolist() == [[0.333, 0.667, 1.0, 1.333]]
+
+
+def test_contour_segments_open_and_closed():
+    square = np.array([[[0, 0]], [[4, 0]], [[4, 4]], [[0, 4]]], dtype=np.int32)
+    point = np.array([[[9, 9]]], dtype=np.int32)
+    assert contour_segments([square, point]).tolist() == [[0, 0, 4, 0], [4, 0, 4, 4], [4, 4, 0, 4]]
+    assert contour_segments([square, point], closed=True).tolist()[-1] == [0, 4, 0, 0]
+    assert contour_segments([]).shape == (0, 4)
+
+
+def test_merge_collinear_segments():
+    segments = np.array([[0, 0, 1, 0], [1, 0, 2, 0], [2, 0, 2, 1], [2, 1, 2, 3], [5, 5, 6, 5], [6, 5, 5, 5]])
+    # 同じ向きに続く線分だけをまとめ、離れた線分・折り返す線分はまとめない
+    assert merge_collinear_segments(segments).tolist() == [[0, 0, 2, 0], [2, 0, 2, 3], [5, 5, 6, 5], [6, 5, 5, 5]]
+
+
+def test_merge_runs_into_blocks():
+    runs = np.array([[0, 0, 3, 0], [5, 0, 6, 0], [0, 1, 3, 1], [5, 1, 7, 1], [0, 2, 3, 2], [0, 4, 3, 4]])
+    assert merge_runs_into_blocks(runs).tolist() == [[0, 0, 3, 2], [5, 0, 6, 0], [5, 1, 7, 1], [0, 4, 3, 4]]
@@ -0,0 +1,116 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+from marking_batch import process_file
+from marking_cache import StageCache
+from marking_pipeline import ImageProcessor
+
+
+# 穴のある図形(輪)と塗りつぶした図形を描いた画像を作る関数
+def ring_image():
+    image = Image.new('L', (400, 200), 255)
+    draw = ImageDraw.Draw(image)
+    draw.ellipse((40, 30, 180, 170), fill=0)
+    draw.ellipse((80, 70, 140, 130), fill=255)
+    draw.rectangle((240, 50, 340, 150), fill=0)
+    return image
+
+
+# 線分を向きを区別せずに並べたリストに変換する関数
+def undirected(segments):
+    return sorted(tuple(sorted([(x1, y1), (x2, y2)])) for x1, y1, x2, y2 in np.asarray(segments).tolist())
+
+
+# 設定を変えたImageProcessorで画像を処理し、出力順の線分を返す関数
+def process(image, stage_cache=None, **settings):
+    processor = ImageProcessor()
+    processor.set_parameters(128, 2, 100)
+    processor.stage_cache = stage_cache
+    processor.image_digest = 'ring' if stage_cache is not None else None
+    for name, value in settings.items():
+        setattr(processor, name, value)
+    return processor.process_image(image), processor
+
+
+def test_rows_after_hatch_on_shared_cache_matches_fresh_rows():
+    image = ring_image()
+    fresh, fresh_processor = process(image)
+    cache = StageCache()
+    process(image, cache, fill_mode='hatch')
+    shared, shared_processor = process(image, cache)
+    # hatchでは穴の輪郭も検出するが、rowsでは外側の輪郭だけを出力する
+    assert len(shared_processor.filtered_contours) == len(fresh_processor.filtered_contours) == 2
+    assert np.array_equal(shared, fresh)
+
+
+def test_hatch_after_rows_on_shared_cache_matches_fresh_hatch():
+    image = ring_image()
+    fresh, _ = process(image, fill_mode='hatch')
+    cache = StageCache()
+    process(image, cache)
+    shared, shared_processor = process(image, cache, fill_mode='hatch')
+    assert len(shared_processor.filtered_contours) == 3
+    assert np.array_equal(shared, fresh)
+
+
+@pytest.mark.parametrize('fill_order', ['raster', 'serpentine'])
+def test_blocks_are_written_as_the_same_rows(fill_order):
+    image = ring_image()
+    rows, _ = process(image, include_contours=False)
+    blocks, _ = process(image, include_contours=False, fill_mode='blocks', fill_order=fill_order)
+    # 矩形は1行ごとの線分に展開して出力するため、向きを除けばrowsと同じ線分になる
+    assert (blocks[:, 1] == blocks[:, 3]).all()
+    assert undirected(blocks) == undirected(rows)
+
+
+def test_stage_keys_depend_only_on_their_parameters():
+    processor = ImageProcessor()
+    before = processor.stage_keys()
+    processor.contour_order = 'nearest'
+    after = processor.stage_keys()
+    # 並べ替えの設定は最後の工程のキーだけを変える
+    assert before[:-1] == after[:-1] and before[-1] != after[-1]
+    processor.simplify_tolerance = 0.5
+    changed = processor.stage_keys()
+    assert changed[:4] == after[:4] and changed[4] != after[4]
+    processor.threshold = 100
+    assert all(key != old for key, old in zip(processor.stage_keys(), changed))
+
+
+def test_shared_cache_reuses_unchanged_stages():
+    image = ring_image()
+    cache = StageCache()
+    first, _ = process(image, cache)
+    misses = cache.misses
+    second, processor = process(image, cache, contour_order='nearest')
+    # 並べ替えだけをやり直し、それより前の工程はキャッシュから取得する
+    assert cache.misses == misses + 1
+    assert undirected(second) == undirected(first)
+    assert processor.travel[1] <= processor.travel[0]
+
+
+@pytest.mark.parametrize('mode, factor', [('nearest', 3), ('area', 2), ('area', 2.5), ('majority', 2.5)])
+def test_tiled_matches_serial(mode, factor):
+    image = ring_image()
+    serial, _ = process(image, coarsen_mode=mode, coarse_coordinates=True, factor=factor)
+    tiled, processor = process(image, coarsen_mode=mode, coarse_coordinates=True, factor=factor,
+                               tile_workers=2, tile_min_pixels=0)
+    assert processor.use_tiles()
+    assert np.array_equal(tiled, serial)
+
+
+@pytest.mark.parametrize('threshold, polarity', [(128, 'black'), (None, 'black'), (128, 'white')])
+def test_stream_matches_batch(tmp_path, threshold, polarity):
+    image_path = tmp_path / 'ring.png'
+    ring_image().save(image_path)
+    options = {'threshold': threshold, 'factor': 3, 'contours': False, 'polarity': polarity}
+    os.mkdir(tmp_path / 'batch')
+    os.mkdir(tmp_path / 'stream')
+    process_file(str(image_path), str(tmp_path / 'batch'), options)
+    process_file(str(image_path), str(tmp_path / 'stream'), {**options, 'stream': True})
+    batch = (tmp_path / 'batch' / 'ring.csv').read_text()
+    assert len(batch.splitlines()) > 1
+    assert (tmp_path / 'stream' / 'ring.csv').read_text() == batch
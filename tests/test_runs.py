@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from marking_engine import extract_runs, runs_to_dict
+
+
+# 書き換え前のddl_marking3.extract_transitionsと同じ、画素ごとに塗りを探す関数(比較の基準)
+def baseline_transitions(image):
+    transitions = {}
+    width, height = image.size
+
+    pixels = image.load()
+    index = 0
+    for y in range(height):
+        start = None
+        for x in range(width):
+            current_pixel = pixels[x, y]
+            if start is None and current_pixel == 0:
+                start = (x, y)
+            elif start is not None and current_pixel == 255:
+                end = (x, y)
+                transitions[index] = (start[0], start[1], end[0], end[1])
+                index += 1
+                start = None
+    return transitions
+
+
+# 0と255だけのランダムな2値画像を作る関数(edge_freeなら右端の列を白にして右端まで続く塗りをなくす)
+def random_binary_image(width, height, seed, black_ratio=0.4, edge_free=False):
+    rng = np.random.default_rng(seed)
+    pixels = np.where(rng.random((height, width)) < black_ratio, 0, 255).astype(np.uint8)
+    if edge_free:
+        pixels[:, -1] = 255
+    return Image.fromarray(pixels, 'L')
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_matches_baseline_without_edge_runs(seed):
+    image = random_binary_image(37, 23, seed, edge_free=True)
+    assert runs_to_dict(extract_runs(image)) == baseline_transitions(image)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_matches_baseline_apart_from_edge_runs(seed):
+    image = random_binary_image(37, 23, seed)
+    runs = extract_runs(image)
+    # 基準は右端まで続く塗りを出力しないため、それ以外が一致することを確かめる
+    inner = runs[runs[:, 2] < image.width]
+    assert list(runs_to_dict(inner).values()) == list(baseline_transitions(image).values())
+
+
+def test_mode_1_image_matches_baseline():
+    image = random_binary_image(40, 12, 7, edge_free=True)
+    assert runs_to_dict(extract_runs(image.convert('1'))) == baseline_transitions(image)
+
+
+def test_closes_runs_at_right_edge():
+    pixels = np.full((3, 6), 255, dtype=np.uint8)
+    pixels[0, 4:] = 0  # 右端まで続く塗り
+    pixels[1, :] = 0  # 行全体の塗り
+    pixels[2, 1:3] = 0  # 途中で終わる塗り
+    pixels[2, 5] = 0  # 右端の1画素だけの塗り
+    runs = extract_runs(Image.fromarray(pixels, 'L'))
+    assert runs.tolist() == [[4, 0, 6, 0], [0, 1, 6, 1], [1, 2, 3, 2], [5, 2, 6, 2]]
+
+
+def test_empty_and_full_rows():
+    assert extract_runs(Image.new('L', (5, 2), 255)).shape == (0, 4)
+    assert extract_runs(Image.new('L', (5, 2), 0)).tolist() == [[0, 0, 5, 0], [0, 1, 5, 1]]
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_white_polarity_equals_black_on_inverted_image(seed):
+    image = random_binary_image(31, 17, seed)
+    inverted = Image.fromarray(255 - np.asarray(image), 'L')
+    assert np.array_equal(extract_runs(image, 'white'), extract_runs(inverted, 'black'))
+
+
+def test_white_polarity_marks_white_pixels():
+    pixels = np.array([[0, 255, 255, 0, 255]], dtype=np.uint8)
+    assert extract_runs(Image.fromarray(pixels, 'L'), 'white').tolist() == [[1, 0, 3, 0], [4, 0, 5, 0]]
+
+
+def test_rejects_unknown_polarity():
+    with pytest.raises(ValueError):
+        extract_runs(Image.new('L', (4, 4), 0), 'gray')
+
+
+@pytest.mark.parametrize('workers', [2, 3, 4, 8])
+@pytest.mark.parametrize('polarity', ['black', 'white'])
+def test_chunked_matches_single_band(workers, polarity):
+    image = random_binary_image(53, 41, workers, black_ratio=0.5)
+    single = extract_runs(image, polarity)
+    chunked = extract_runs(image, polarity, workers=workers)
+    assert chunked.dtype == single.dtype
+    assert np.array_equal(chunked, single)
+
+
+def test_chunked_with_fewer_rows_than_workers():
+    image = random_binary_image(20, 3, 11)
+    assert np.array_equal(extract_runs(image, workers=4), extract_runs(image))
@@ -0,0 +1,116 @@
+import cv2
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+from marking_engine import output_matrix
+from marking_hatch import hatch_segments
+from marking_toolpath import blocks_to_rows, order_chains, schedule_segments, serpentine_order, travel_distance
+
+
+# 線分を向きを区別せずに並べたリストに変換する関数(並べ替えで線分が失われていないかを比べる)
+def undirected(segments):
+    points = np.array(segments, dtype=np.float64).reshape(-1, 2, 2)
+    flipped = (points[:, 0, 0] > points[:, 1, 0]) | ((points[:, 0, 0] == points[:, 1, 0])
+                                                      & (points[:, 0, 1] > points[:, 1, 1]))
+    points[flipped] = points[flipped][:, ::-1]
+    return sorted(map(tuple, points.reshape(-1, 4).tolist()))
+
+
+# 離れた位置にある正方形の輪郭の線分を作る関数
+def square_chains(corners):
+    segments = []
+    for x, y in corners:
+        points = [(x, y), (x + 2, y), (x + 2, y + 2), (x, y + 2), (x, y)]
+        segments += [(*a, *b) for a, b in zip(points[:-1], points[1:])]
+    return np.array(segments, dtype=np.int32)
+
+
+def test_travel_distance():
+    segments = np.array([[0, 0, 1, 0], [4, 4, 5, 4], [5, 4, 6, 4]])
+    assert travel_distance(segments) == pytest.approx(5.0)
+    # 行列があれば出力座標で測る
+    assert travel_distance(segments, np.diag([2.0, 2.0, 1.0])) == pytest.approx(10.0)
+
+
+def test_serpentine_order_reverses_every_other_row():
+    runs = np.array([[0, 0, 2, 0], [4, 0, 6, 0], [0, 1, 2, 1], [4, 1, 6, 1]])
+    assert serpentine_order(runs).tolist() == [[0, 0, 2, 0], [4, 0, 6, 0], [6, 1, 4, 1], [2, 1, 0, 1]]
+
+
+def test_blocks_to_rows():
+    blocks = np.array([[0, 0, 3, 2], [5, 4, 6, 4]])
+    assert blocks_to_rows(blocks).tolist() == [[0, 0, 3, 0], [0, 1, 3, 1], [0, 2, 3, 2], [5, 4, 6, 4]]
+    assert blocks_to_rows(blocks, serpentine=True).tolist() == [[0, 0, 3, 0], [3, 1, 0, 1], [0, 2, 3, 2],
+                                                                [5, 4, 6, 4]]
+    assert blocks_to_rows(np.empty((0, 4), dtype=np.int32)).shape == (0, 4)
+
+
+@pytest.mark.parametrize('method', ['nearest', '2opt'])
+def test_order_chains_keeps_segments_and_shortens_travel(method):
+    contours = square_chains([(50, 50), (0, 0), (100, 0), (10, 0), (60, 50)])
+    ordered = order_chains(contours, method=method)
+    assert undirected(ordered) == undirected(contours)
+    assert travel_distance(ordered) < travel_distance(contours)
+    # 経路は途中で切らずに並べ替える
+    assert ((ordered[1:, :2] == ordered[:-1, 2:]).all(axis=1)).sum() == len(contours) - 5
+
+
+def test_two_opt_is_not_worse_than_nearest():
+    rng = np.random.default_rng(0)
+    contours = square_chains(rng.integers(0, 200, (30, 2)).tolist())
+    nearest = order_chains(contours, method='nearest')
+    improved = order_chains(contours, method='2opt')
+    assert travel_distance(improved) <= travel_distance(nearest) + 1e-9
+
+
+def test_schedule_segments_starts_contours_at_last_fill():
+    fills = np.array([[0, 0, 5, 0]])
+    contours = square_chains([(100, 100), (6, 0)])
+    scheduled = schedule_segments(fills, contours, contour_order='nearest')
+    assert scheduled[:1].tolist() == fills.tolist()
+    assert scheduled[1, :2].tolist() == [6, 0]
+
+
+# 画像の黒い図形の輪郭(穴を含む)を検出する関数
+def find_contours(image):
+    return cv2.findContours(255 - np.asarray(image), cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)[0]
+
+
+# 黒い矩形の輪郭から、出力座標で一定の間隔の塗りの線を作る関数
+def rectangle_hatch(angle, pitch=0.5, serpentine=False):
+    image = Image.new('L', (100, 50), 255)
+    ImageDraw.Draw(image).rectangle((20, 10, 79, 39), fill=0)
+    matrix = output_matrix(image.size)
+    return hatch_segments(find_contours(image), matrix, pitch, angle, serpentine), matrix
+
+
+def test_hatch_lines_are_inside_and_evenly_spaced():
+    hatch, matrix = rectangle_hatch(0.0)
+    assert len(hatch)
+    assert (hatch[:, [0, 2]] >= 20 - 1e-6).all() and (hatch[:, [0, 2]] <= 79 + 1e-6).all()
+    assert (hatch[:, [1, 3]] >= 10 - 1e-6).all() and (hatch[:, [1, 3]] <= 39 + 1e-6).all()
+    # 出力座標では走査線が水平で、間隔がpitchになる
+    projected = hatch.reshape(-1, 2) @ matrix[:2, :2].T + matrix[:2, 2]
+    ys = np.unique(np.round(projected[:, 1], 6))
+    assert np.allclose(np.diff(ys), 0.5)
+
+
+def test_hatch_skips_holes():
+    image = Image.new('L', (100, 100), 255)
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((10, 10, 89, 89), fill=0)
+    draw.rectangle((40, 40, 59, 59), fill=255)
+    hatch = hatch_segments(find_contours(image), np.eye(3), 1.0)
+    through_hole = hatch[(hatch[:, 1] > 41) & (hatch[:, 1] < 58)]
+    # 穴を通る走査線は穴の左右の2つの区間に分かれ、穴の中に線を引かない
+    assert len(through_hole) and not ((through_hole[:, 0] < 50) & (through_hole[:, 2] > 50)).any()
+
+
+def test_hatch_serpentine_alternates_direction():
+    hatch, _ = rectangle_hatch(0.0, serpentine=True)
+    raster, _ = rectangle_hatch(0.0)
+    assert undirected(hatch) == undirected(raster)
+    # 画像の座標で各線が進むY方向の向き(出力座標の走査線に沿う向き)が交互に入れ替わる
+    directions = np.sign(hatch[:, 3] - hatch[:, 1])
+    assert (directions[1:] != directions[:-1]).all()
@@ -0,0 +1,71 @@
+import json
+
+import numpy as np
+import pytest
+
+from marking_writers import BINARY_HEADERS, BINARY_MAGIC, read_binary, write_segments
+
+METADATA = {'angle': 90.0, 'scale': (0.5, 0.25), 'offset': (10.0, -20.0), 'transformed': True}
+
+
+# 出力座標に変換済みのような小数の座標を作る関数
+def sample_segments():
+    return np.array([[10.0, -20.0, 9.5, -19.75], [1.25, 2.5, 3.75, 5.0], [0.0, 0.0, 0.0, 0.0]])
+
+
+def test_binary_round_trip(tmp_path):
+    path = tmp_path / 'zahyou.bin'
+    write_segments(str(path), sample_segments(), METADATA)
+    array, metadata = read_binary(str(path))
+    assert array.dtype == np.dtype('<f4')
+    assert np.array_equal(array, sample_segments().astype('<f4'))
+    assert metadata['angle'] == 90.0 and metadata['transformed'] is True
+    assert metadata['scale'] == pytest.approx((0.5, 0.25)) and metadata['offset'] == pytest.approx((10.0, -20.0))
+
+
+def test_binary_records_untransformed_segments(tmp_path):
+    path = tmp_path / 'zahyou.bin'
+    write_segments(str(path), {0: (1, 2, 3, 4)}, {**METADATA, 'transformed': False})
+    array, metadata = read_binary(str(path))
+    assert array.tolist() == [[1, 2, 3, 4]] and metadata['transformed'] is False
+
+
+def test_reads_version_1_binary(tmp_path):
+    path = tmp_path / 'old.bin'
+    with open(path, 'wb') as file:
+        file.write(BINARY_HEADERS[1].pack(BINARY_MAGIC, 1, 0, 1, 0.5, 0.25, 10.0, -20.0))
+        file.write(np.array([[1, 2, 3, 4]], dtype='<f4').tobytes())
+    array, metadata = read_binary(str(path))
+    # バージョン1は回転角度を記録せず、座標は変換済み
+    assert array.tolist() == [[1, 2, 3, 4]]
+    assert metadata['angle'] is None and metadata['transformed'] is True
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / 'zahyou.csv'
+    path.write_bytes(b'Index,X1,Y1,X2,Y2\n')
+    with pytest.raises(ValueError):
+        read_binary(str(path))
+
+
+def test_npy_and_npz_match_binary(tmp_path):
+    segments = sample_segments()
+    write_segments(str(tmp_path / 'zahyou.npy'), segments, METADATA)
+    write_segments(str(tmp_path / 'zahyou.npz'), segments, METADATA)
+    assert np.array_equal(np.load(tmp_path / 'zahyou.npy'), segments.astype('<f4'))
+    with open(tmp_path / 'zahyou.json') as file:
+        assert json.load(file) == {'angle': 90.0, 'scale': [0.5, 0.25], 'offset': [10.0, -20.0], 'transformed': True}
+    with np.load(tmp_path / 'zahyou.npz') as archive:
+        assert np.array_equal(archive['segments'], segments.astype('<f4'))
+        assert float(archive['angle']) == 90.0 and bool(archive['transformed'])
+
+
+def test_csv_has_index_column(tmp_path):
+    path = tmp_path / 'zahyou.csv'
+    write_segments(str(path), sample_segments()[:2], METADATA)
+    assert path.read_text().splitlines() == ['Index,X1,Y1,X2,Y2', '0,10.0,-20.0,9.5,-19.75', '1,1.25,2.5,3.75,5.0']
+
+
+def test_rejects_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        write_segments(str(tmp_path / 'zahyou.txt'), sample_segments())